@@ -0,0 +1,362 @@
+# encoding: utf-8
+""" An in-process stand-in for Mopidy's MPD frontend.
+
+It implements the part of the MPD protocol the skill uses, with a generated
+library, a configurable delay per round trip and per command, and counters
+for round trips and for when playback was started.
+"""
+
+import random
+import select
+import shlex
+import socketserver
+import threading
+import time
+
+HELLO = "OK MPD 0.19.0\n"
+
+
+class FakeLibrary:
+    """A generated library of ``size`` local tracks and ``n_playlists`` stored playlists."""
+
+    def __init__(self, size=1000, n_artists=50, n_albums=100, n_playlists=20, playlist_size=50):
+        self.songs = [
+            {
+                'file': 'local:track:{}'.format(i),
+                'Title': 'Title {}'.format(i),
+                'Artist': 'Artist {}'.format(i % n_artists),
+                'Album': 'Album {}'.format(i % n_albums),
+            }
+            for i in range(size)
+        ]
+        self.by_uri = {song['file']: song for song in self.songs}
+        self.playlists = {
+            'Playlist {}'.format(i): [self.songs[(i * playlist_size + j) % size]['file'] for j in range(playlist_size)]
+            for i in range(n_playlists)
+        } if size else {}
+
+    def song(self, uri):
+        return self.by_uri.get(uri, {'file': uri, 'Title': uri, 'Artist': 'Unknown', 'Album': 'Unknown'})
+
+
+class FakeMopidyServer(socketserver.ThreadingTCPServer):
+    """Serves the MPD protocol on ``127.0.0.1`` and a free port.
+
+    :param rtt: Delay added to every round trip, in seconds
+    :param command_latency: Extra delay per command name, in seconds
+    :param unavailable: URIs which ``add`` rejects
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, library=None, rtt=0.0, command_latency=None, unavailable=()):
+        super().__init__(('127.0.0.1', 0), FakeMopidyHandler)
+        self.library = library if library is not None else FakeLibrary()
+        self.rtt = rtt
+        self.command_latency = command_latency or {}
+        self.unavailable = set(unavailable)
+        self.lock = threading.RLock()
+        self.handlers = set()
+        self.queue = []
+        self.next_id = 1
+        self.playlist_version = 1
+        self.current = None
+        self.state = 'stop'
+        self.volume = 50
+        self.elapsed = 0.0
+        self.reset_stats()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.round_trips = 0
+            self.commands = 0
+            self.first_play_at = None
+
+    def notify(self, *subsystems):
+        for handler in list(self.handlers):
+            handler.changed.update(subsystems)
+
+    # Command implementations. Each returns a list of response lines.
+
+    def _song_lines(self, entry, pos=None):
+        song = self.library.song(entry['file'])
+        lines = ['{}: {}'.format(k, v) for k, v in song.items()]
+        if pos is not None:
+            lines += ['Pos: {}'.format(pos), 'Id: {}'.format(entry['id'])]
+        return lines
+
+    def _changed(self, start=0):
+        """Mark the songs from ``start`` on as changed in a new queue version, like MPD."""
+        self.playlist_version += 1
+        if self.current is not None and self.current >= len(self.queue):
+            self.current = len(self.queue) - 1 if self.queue else None
+        for entry in self.queue[start:]:
+            entry['version'] = self.playlist_version
+        self.notify('playlist')
+
+    def _add(self, uri):
+        if uri in self.unavailable:
+            raise CommandFailed(50, "No such song")
+        entry = {'file': uri, 'id': self.next_id}
+        self.next_id += 1
+        self.queue.append(entry)
+        self._changed(len(self.queue) - 1)
+        return entry
+
+    def _pos_of_id(self, song_id):
+        for pos, entry in enumerate(self.queue):
+            if entry['id'] == song_id:
+                return pos
+        raise CommandFailed(50, "No such song")
+
+    def _play(self, pos=0):
+        if not self.queue:
+            self.state = 'stop'
+            return
+        self.current = min(pos, len(self.queue) - 1)
+        self.state = 'play'
+        self.elapsed = 0.0
+        if self.first_play_at is None:
+            self.first_play_at = time.monotonic()
+        self.notify('player')
+
+    def _shuffle(self, span=None):
+        start, end = 0, len(self.queue)
+        if span:
+            first, _, last = span.partition(':')
+            start = int(first)
+            end = int(last) if last else end
+        part = self.queue[start:end]
+        random.shuffle(part)
+        self.queue[start:end] = part
+        self._changed(start)
+
+    def _matching(self, tag, value, exact):
+        key = tag.capitalize() if tag != 'any' else None
+        matches = []
+        for song in self.library.songs:
+            values = [song[key]] if key else list(song.values())
+            if any(v == value if exact else value.lower() in v.lower() for v in values):
+                matches.append(song)
+        return matches
+
+    def execute(self, command, args):
+        if command == 'ping':
+            return []
+        if command == 'status':
+            lines = ['volume: {}'.format(self.volume), 'state: {}'.format(self.state),
+                     'playlist: {}'.format(self.playlist_version), 'playlistlength: {}'.format(len(self.queue)),
+                     'random: 0', 'repeat: 0']
+            if self.current is not None and self.queue:
+                lines += ['song: {}'.format(self.current), 'songid: {}'.format(self.queue[self.current]['id']),
+                          'elapsed: {:.3f}'.format(self.elapsed)]
+            return lines
+        if command == 'currentsong':
+            if self.current is None or not self.queue:
+                return []
+            return self._song_lines(self.queue[self.current], self.current)
+        if command == 'setvol':
+            self.volume = int(args[0])
+            self.notify('mixer')
+            return []
+        if command in ('pause', 'stop'):
+            self.state = 'pause' if command == 'pause' and self.state != 'stop' else 'stop'
+            self.notify('player')
+            return []
+        if command == 'play':
+            if args and int(args[0]) >= len(self.queue):
+                raise CommandFailed(2, "Bad song index")
+            self._play(int(args[0]) if args else (self.current or 0))
+            return []
+        if command == 'playid':
+            self._play(self._pos_of_id(int(args[0])))
+            return []
+        if command in ('next', 'previous'):
+            step = 1 if command == 'next' else -1
+            if self.current is None or not 0 <= self.current + step < len(self.queue):
+                raise CommandFailed(55, "Not playing")
+            self._play(self.current + step)
+            return []
+        if command == 'seekcur':
+            self.elapsed = float(args[0])
+            return []
+        if command == 'clear':
+            self.queue = []
+            self.current = None
+            self.state = 'stop'
+            self._changed()
+            self.notify('player')
+            return []
+        if command == 'add':
+            self._add(args[0])
+            return []
+        if command == 'addid':
+            entry = self._add(args[0])
+            if len(args) > 1:
+                self.queue.insert(int(args[1]), self.queue.pop())
+                self._changed(int(args[1]))
+            return ['Id: {}'.format(entry['id'])]
+        if command == 'deleteid':
+            pos = self._pos_of_id(int(args[0]))
+            del self.queue[pos]
+            self._changed(pos)
+            return []
+        if command == 'moveid':
+            pos = self._pos_of_id(int(args[0]))
+            entry = self.queue.pop(pos)
+            self.queue.insert(int(args[1]), entry)
+            self._changed(min(pos, int(args[1])))
+            return []
+        if command == 'shuffle':
+            self._shuffle(args[0] if args else None)
+            return []
+        if command == 'playlist':
+            return ['{}:file: {}'.format(pos, entry['file']) for pos, entry in enumerate(self.queue)]
+        if command == 'plchanges':
+            lines = []
+            for pos, entry in enumerate(self.queue):
+                if entry.get('version', 0) > int(args[0]):
+                    lines += self._song_lines(entry, pos)
+            return lines
+        if command == 'playlistinfo':
+            lines = []
+            for pos, entry in enumerate(self.queue):
+                lines += self._song_lines(entry, pos)
+            return lines
+        if command == 'listplaylists':
+            return ['playlist: {}'.format(name) for name in self.library.playlists]
+        if command == 'listplaylist':
+            if args[0] not in self.library.playlists:
+                raise CommandFailed(50, "No such playlist")
+            return ['file: {}'.format(uri) for uri in self.library.playlists[args[0]]]
+        if command == 'load':
+            if args[0] not in self.library.playlists:
+                raise CommandFailed(50, "No such playlist")
+            for uri in self.library.playlists[args[0]]:
+                self._add(uri)
+            return []
+        if command == 'list':
+            key = args[0].capitalize()
+            return ['{}: {}'.format(key, value) for value in sorted({song[key] for song in self.library.songs})]
+        if command in ('find', 'search'):
+            lines = []
+            for song in self._matching(args[0], args[1], command == 'find'):
+                lines += ['{}: {}'.format(k, v) for k, v in song.items()]
+            return lines
+        if command in ('findadd', 'searchadd'):
+            for song in self._matching(args[0], args[1], command == 'findadd'):
+                self._add(song['file'])
+            return []
+        raise CommandFailed(5, "unknown command \"{}\"".format(command))
+
+
+class CommandFailed(Exception):
+
+    def __init__(self, errno, message):
+        super().__init__(message)
+        self.errno = errno
+
+
+class FakeMopidyHandler(socketserver.StreamRequestHandler):
+    # Unbuffered, so select() on the socket sees a noidle sent during idle.
+    rbufsize = 0
+
+    def setup(self):
+        super().setup()
+        self.changed = set()
+        self.server.handlers.add(self)
+
+    def finish(self):
+        self.server.handlers.discard(self)
+        super().finish()
+
+    def send(self, lines):
+        self.wfile.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+        self.wfile.flush()
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return shlex.split(line.decode('utf-8')) or ['']
+
+    def handle(self):
+        self.wfile.write(HELLO.encode('utf-8'))
+        while True:
+            parts = self.read_command()
+            if parts is None:
+                return
+            if parts[0] in ('command_list_begin', 'command_list_ok_begin'):
+                list_ok = parts[0] == 'command_list_ok_begin'
+                batch = []
+                while True:
+                    parts = self.read_command()
+                    if parts is None:
+                        return
+                    if parts[0] == 'command_list_end':
+                        break
+                    batch.append(parts)
+                self.run(batch, list_ok)
+            elif parts[0] == 'idle':
+                if not self.idle(parts[1:]):
+                    return
+            elif parts[0] == 'noidle':
+                self.send(['OK'])
+            elif parts[0] == 'close':
+                return
+            else:
+                self.run([parts], False)
+
+    def run(self, batch, list_ok):
+        server = self.server
+        time.sleep(server.rtt + sum(server.command_latency.get(parts[0], 0) for parts in batch))
+        lines = []
+        with server.lock:
+            server.round_trips += 1
+            for offset, parts in enumerate(batch):
+                server.commands += 1
+                try:
+                    lines += server.execute(parts[0], parts[1:])
+                except CommandFailed as e:
+                    lines.append('ACK [{}@{}] {{{}}} {}'.format(e.errno, offset, parts[0], e))
+                    self.send(lines)
+                    return
+                except (IndexError, ValueError) as e:
+                    lines.append('ACK [2@{}] {{{}}} {}'.format(offset, parts[0], e))
+                    self.send(lines)
+                    return
+                if list_ok:
+                    lines.append('list_OK')
+        self.send(lines + ['OK'])
+
+    def idle(self, subsystems):
+        """Wait for a change or a noidle; returns False if the client went away."""
+        wanted = set(subsystems)
+        while True:
+            changed = {s for s in self.changed if not wanted or s in wanted}
+            if changed:
+                self.changed -= changed
+                self.send(['changed: {}'.format(s) for s in sorted(changed)] + ['OK'])
+                return True
+            readable, _, _ = select.select([self.connection], [], [], 0.05)
+            if readable:
+                parts = self.read_command()
+                if parts is None:
+                    return False
+                # Only noidle is allowed while idle.
+                self.send(['OK'])
+                return True
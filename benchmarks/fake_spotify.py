@@ -0,0 +1,214 @@
+# encoding: utf-8
+""" A local stand-in for the Spotify Web API endpoints SpotifyClient uses.
+
+Every name searched for is found, and playlists, albums and top tracks
+are generated on demand with configurable sizes, so any query works.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+ID_LENGTH = 22
+
+
+def make_id(kind, n):
+    """A Spotify-like 22 character id."""
+    prefix = kind[:2]
+    return prefix + str(n).rjust(ID_LENGTH - len(prefix), '0')
+
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    """Serves the Spotify endpoints on ``127.0.0.1`` and a free port.
+
+    :param latency: Delay added to every request, in seconds
+    :param playlist_size: Number of tracks in each playlist
+    :param album_size: Number of tracks in each album
+    :param n_user_playlists: Number of playlists of the user
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, playlist_size=100, album_size=12, n_user_playlists=50):
+        super().__init__(('127.0.0.1', 0), FakeSpotifyHandler)
+        self.latency = latency
+        self.playlist_size = playlist_size
+        self.album_size = album_size
+        self.n_user_playlists = n_user_playlists
+        # When set, every API request is answered with this status and a Retry-After.
+        self.unavailable_status = None
+        self.lock = threading.Lock()
+        self.names = {}
+        self.requests = {}
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    @property
+    def token_url(self):
+        return self.api_url + 'api/token'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = {}
+
+    @property
+    def total_requests(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def id_for(self, kind, name):
+        with self.lock:
+            key = (kind, name.lower())
+            if key not in self.names:
+                self.names[key] = make_id(kind, len(self.names))
+            return self.names[key]
+
+    def track(self, n):
+        return {
+            'id': make_id('track', n),
+            'uri': 'spotify:track:{}'.format(make_id('track', n)),
+            'name': 'Track {}'.format(n),
+            'artists': [{'id': make_id('artist', n % 97), 'name': 'Artist {}'.format(n % 97)}],
+        }
+
+    def playlist(self, playlist_id, name):
+        return {
+            'id': playlist_id,
+            'name': name,
+            'snapshot_id': 'snapshot-{}'.format(playlist_id),
+            'tracks': {
+                'href': '{}v1/playlists/{}/tracks'.format(self.api_url, playlist_id),
+                'total': self.playlist_size,
+            },
+        }
+
+    def page(self, items, total, query):
+        limit = int(query.get('limit', ['20'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+        return {
+            'items': [items(i) for i in range(offset, min(offset + limit, total))],
+            'total': total,
+            'limit': limit,
+            'offset': offset,
+        }
+
+    def get(self, path, query):
+        """The JSON response and endpoint label for a GET request, or None."""
+        if path == '/v1/me':
+            return {'id': 'benchmark-user'}, 'me'
+        if path == '/v1/me/playlists':
+            return self.page(
+                lambda i: self.playlist(make_id('playlist', i), 'User Playlist {}'.format(i)),
+                self.n_user_playlists, query), 'me/playlists'
+        match = re.match(r'^/v1/me/top/(artists|tracks)$', path)
+        if match:
+            kind = match.group(1)[:-1]
+            return self.page(lambda i: {'id': make_id(kind, i), 'name': '{} {}'.format(kind.capitalize(), i)},
+                             200, query), 'me/top'
+        if path == '/v1/me/tracks':
+            return self.page(lambda i: {'track': self.track(i)}, 500, query), 'me/tracks'
+        if path == '/v1/search':
+            name = query['q'][0]
+            kind = query['type'][0]
+            item_id = self.id_for(kind, name)
+            if kind == 'playlist':
+                item = self.playlist(item_id, name)
+            elif kind == 'track':
+                item = self.track(int(item_id[2:]))
+            else:
+                item = {'id': item_id, 'name': name, 'uri': 'spotify:{}:{}'.format(kind, item_id)}
+            return {kind + 's': {'items': [item], 'total': 1}}, 'search'
+        match = re.match(r'^/v1/artists/(\w+)/top-tracks$', path)
+        if match:
+            base = int(match.group(1)[2:]) * 10
+            return {'tracks': [self.track(base + i) for i in range(10)]}, 'artists/top-tracks'
+        match = re.match(r'^/v1/albums/(\w+)/tracks$', path)
+        if match:
+            base = int(match.group(1)[2:]) * 1000
+            return self.page(lambda i: self.track(base + i), self.album_size, query), 'albums/tracks'
+        match = re.match(r'^/v1/playlists/(\w+)/tracks$', path)
+        if match:
+            base = int(match.group(1)[2:]) * 100000
+            return self.page(lambda i: {'track': self.track(base + i)}, self.playlist_size, query), \
+                'playlists/tracks'
+        return None
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def handle_api(self, method):
+        server = self.server
+        time.sleep(server.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if method == 'POST' and url.path == '/api/token':
+            length = int(self.headers.get('Content-Length', 0))
+            self.rfile.read(length)
+            server.count('token')
+            self.send_json(200, {'access_token': 'benchmark-token', 'token_type': 'Bearer', 'expires_in': 3600})
+            return
+        if method == 'HEAD':
+            server.count('head')
+            self.send_json(200, {})
+            return
+        if server.unavailable_status is not None:
+            server.count('unavailable')
+            self.send_json(server.unavailable_status, {'error': {'status': server.unavailable_status}},
+                           [('Retry-After', '1')])
+            return
+        if method == 'PUT':
+            server.count('put')
+            self.send_json(200, {})
+            return
+        response = server.get(url.path, query)
+        if response is None:
+            self.send_json(404, {'error': {'status': 404, 'message': 'Not found'}})
+            return
+        body, endpoint = response
+        server.count(endpoint)
+        self.send_json(200, body)
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def do_PUT(self):
+        self.handle_api('PUT')
+
+    def do_HEAD(self):
+        self.handle_api('HEAD')
+
+    def log_message(self, format, *args):
+        pass
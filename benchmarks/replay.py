@@ -0,0 +1,307 @@
+#! /usr/bin/env python
+# encoding: utf-8
+""" Replays recorded Hermes MQTT traffic against a SnipsMopidyListener.
+
+A recording is a JSON lines file of ``{"t": seconds, "topic": ..., "payload": {...}}``
+messages, as captured from the broker, for any number of site_ids. The
+messages are delivered one at a time on a single thread, as the MQTT client
+delivers them, to a listener whose rooms are FakeMopidyServers. Each run
+replays the recording at one speed-up factor and reports dropped and late
+responses, callback lag, room queue depth and per-room response latency.
+
+Without ``--recording`` a synthetic recording is generated. Run it from the
+repository root; it needs snipslistener installed.
+"""
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import Future
+import contextlib
+from functools import partial
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.run import Bench, FakeIntentData, format_seconds, make_listener, percentile  # noqa: E402
+
+# Snips gives up on a session which is not ended within this, in seconds.
+RESPONSE_DEADLINE = 1.0
+DRAIN_TIMEOUT = 30
+SAMPLE_INTERVAL = 0.01
+
+HOTWORD_HANDLER = 'set_to_low_volume'
+SESSION_ENDED_HANDLER = 'restore_volume'
+INTENT_HANDLERS = {
+    'speakerInterrupt': 'pause',
+    'volumeUp': 'volume_up',
+    'volumeDown': 'volume_down',
+    'playPlaylist': 'play_playlist',
+    'playArtist': 'play_artist',
+    'playSong': 'play_song',
+    'playAlbum': 'play_album',
+    'resumeMusic': 'resume',
+    'resumePreviousMusic': 'resume_previous',
+    'nextSong': 'next_song',
+    'previousSong': 'prev_song',
+    'addSong': 'add_song',
+    'getInfos': 'get_info',
+}
+
+SYNTHETIC_INTENTS = [
+    ('playPlaylist', lambda i: {'playlist_name': 'Playlist {}'.format(i % 20)}),
+    ('playArtist', lambda i: {'artist_name': 'Artist {}'.format(i % 50)}),
+    ('volumeUp', lambda i: {}),
+    ('volumeDown', lambda i: {}),
+    ('getInfos', lambda i: {}),
+    ('nextSong', lambda i: {}),
+    ('speakerInterrupt', lambda i: {}),
+    ('resumeMusic', lambda i: {}),
+]
+
+
+def load_recording(path):
+    with open(path) as infile:
+        messages = [json.loads(line) for line in infile if line.strip()]
+    messages.sort(key=lambda message: message['t'])
+    return messages
+
+
+def generate_recording(n_sites, sessions_per_site, interval, seed=0):
+    """A recording of hotword, intent and session end for each of ``sessions_per_site`` per site."""
+    rng = random.Random(seed)
+    messages = []
+    for site in range(n_sites):
+        site_id = 'default' if site == 0 else 'room{}'.format(site)
+        t = rng.uniform(0, interval)
+        for i in range(sessions_per_site):
+            session_id = '{}-{}'.format(site_id, i)
+            intent_name, slots = SYNTHETIC_INTENTS[rng.randrange(len(SYNTHETIC_INTENTS))]
+            messages += [
+                {'t': t, 'topic': 'hermes/hotword/default/detected',
+                 'payload': {'siteId': site_id, 'modelId': 'default'}},
+                {'t': t + 1.5, 'topic': 'hermes/intent/{}'.format(intent_name),
+                 'payload': {'sessionId': session_id, 'siteId': site_id, 'intent': {'intentName': intent_name},
+                             'slots': [{'slotName': name, 'value': {'kind': 'Custom', 'value': value}}
+                                       for name, value in slots(i).items()]}},
+                {'t': t + 1.6, 'topic': 'hermes/dialogueManager/sessionEnded',
+                 'payload': {'sessionId': session_id, 'siteId': site_id}},
+            ]
+            t += rng.uniform(interval / 2, interval * 1.5)
+    messages.sort(key=lambda message: message['t'])
+    return messages
+
+
+def route(message):
+    """The listener handler name and intent data for a recorded message, or None."""
+    topic, payload = message['topic'], message['payload']
+    slots = {slot['slotName']: slot['value']['value'] for slot in payload.get('slots', ())}
+    data = FakeIntentData(payload['siteId'], **slots)
+    data.session_id = payload.get('sessionId')
+    if topic.startswith('hermes/hotword/') and topic.endswith('/detected'):
+        return HOTWORD_HANDLER, data
+    if topic == 'hermes/dialogueManager/sessionEnded':
+        return SESSION_ENDED_HANDLER, data
+    if topic.startswith('hermes/intent/'):
+        handler = INTENT_HANDLERS.get(topic[len('hermes/intent/'):].split(':')[-1])
+        if handler is not None:
+            return handler, data
+    return None
+
+
+class FakeBroker:
+    """Delivers messages to the listener from one thread, at their scheduled times.
+
+    Like the MQTT client's network loop, a message is only delivered once the
+    callback for the previous one has returned, so a slow synchronous handler
+    delays everything queued behind it.
+    """
+
+    def __init__(self, listener, messages, speed):
+        self.listener = listener
+        self.messages = messages
+        self.speed = speed
+        self.intents = []
+        self.lags = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def run(self):
+        start = time.monotonic()
+        for message in self.messages:
+            due = start + message['t'] / self.speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.lags.append(time.monotonic() - due)
+            routed = route(message)
+            if routed is None:
+                continue
+            handler, data = routed
+            if handler in INTENT_HANDLERS.values():
+                self.intents.append((due, data))
+            try:
+                result = getattr(self.listener, handler)(data)
+            except Exception:
+                self.fail(data)
+            else:
+                # Queued on a room's dispatcher; errors surface on the future.
+                if isinstance(result, Future):
+                    result.add_done_callback(partial(self.check, data))
+
+    def check(self, data, future):
+        if future.exception() is not None:
+            self.fail(data)
+
+    def fail(self, data):
+        data.failed = True
+        with self.lock:
+            self.errors += 1
+
+
+class QueueSampler(threading.Thread):
+    """Records the largest dispatcher queue depth seen for each room."""
+
+    def __init__(self, dispatcher, rooms):
+        super().__init__(daemon=True)
+        self.dispatcher = dispatcher
+        self.rooms = rooms
+        self.max_depth = defaultdict(int)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            for room in self.rooms:
+                self.max_depth[room] = max(self.max_depth[room], self.dispatcher.queue_depth(room))
+
+
+def wait_for_responses(intents, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(data.session_manager.ended_at is not None or getattr(data, 'failed', False)
+               for _, data in intents):
+            return
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def replay(messages, speed, args):
+    """Replay ``messages`` at ``speed`` times real time and summarise the responses."""
+    site_ids = sorted({message['payload']['siteId'] for message in messages})
+    bench = Bench(len(site_ids), args.rtt, args.library_size, args.playlist_size,
+                  spotify_latency=args.spotify_latency, site_ids=site_ids)
+    listener = make_listener(bench.skill)
+    if args.async_rooms:
+        from snipsmopidy.dispatch import RoomDispatcher
+
+        listener.dispatcher = RoomDispatcher()
+    sampler = None
+    if listener.dispatcher is not None:
+        sampler = QueueSampler(listener.dispatcher, site_ids)
+        sampler.start()
+    broker = FakeBroker(listener, messages, speed)
+    try:
+        broker.run()
+        wait_for_responses(broker.intents, args.drain_timeout)
+    finally:
+        if sampler is not None:
+            sampler.stopped.set()
+        if listener.dispatcher is not None:
+            listener.dispatcher.close()
+        bench.close()
+
+    latencies = defaultdict(list)
+    dropped = late = 0
+    for due, data in broker.intents:
+        if data.session_manager.ended_at is None:
+            dropped += 1
+            continue
+        latency = data.session_manager.ended_at - due
+        latencies[data.site_id].append(latency)
+        if latency > args.deadline:
+            late += 1
+    return {
+        'speed': speed,
+        'rooms': len(site_ids),
+        'messages': len(messages),
+        'intents': len(broker.intents),
+        'errors': broker.errors,
+        'dropped': dropped,
+        'late': late,
+        'max_callback_lag': max(broker.lags) if broker.lags else None,
+        'max_queue_depth': max(sampler.max_depth.values()) if sampler and sampler.max_depth else None,
+        'per_room': {
+            room: {
+                'p50': percentile(latencies[room], 50),
+                'p99': percentile(latencies[room], 99),
+                'max_queue_depth': sampler.max_depth[room] if sampler else None,
+            }
+            for room in site_ids
+        },
+    }
+
+
+def print_report(results, verbose):
+    print('{:>7} {:>5} {:>8} {:>7} {:>7} {:>7} {:>7} {:>13} {:>11}'.format(
+        'speed', 'rooms', 'messages', 'intents', 'errors', 'dropped', 'late', 'callback lag', 'queue depth'))
+    for r in results:
+        print('{:>6}x {:>5} {:>8} {:>7} {:>7} {:>7} {:>7} {:>13} {:>11}'.format(
+            r['speed'], r['rooms'], r['messages'], r['intents'], r['errors'], r['dropped'], r['late'],
+            format_seconds(r['max_callback_lag']),
+            '-' if r['max_queue_depth'] is None else r['max_queue_depth']))
+        if verbose:
+            for room, stats in sorted(r['per_room'].items()):
+                print('        {:<20} p50 {:>9}  p99 {:>9}  queue depth {}'.format(
+                    room, format_seconds(stats['p50']), format_seconds(stats['p99']),
+                    '-' if stats['max_queue_depth'] is None else stats['max_queue_depth']))
+
+
+def float_list(value):
+    return [float(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recording", help="JSON lines file of recorded Hermes messages")
+    parser.add_argument("--sites", type=int, default=8, help="Sites in a generated recording")
+    parser.add_argument("--sessions", type=int, default=20, help="Sessions per site in a generated recording")
+    parser.add_argument("--interval", type=float, default=10.0,
+                        help="Mean seconds between sessions of a site in a generated recording")
+    parser.add_argument("--speed", type=float_list, default=[1, 10, 50], help="Speed-up factors, e.g. 1,10,100")
+    parser.add_argument("--async-rooms", action='store_true', help="Run handlers on per-room queues")
+    parser.add_argument("--deadline", type=float, default=RESPONSE_DEADLINE,
+                        help="Responses slower than this are late, in seconds")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+                        help="Responses not sent this long after the last message are dropped, in seconds")
+    parser.add_argument("--library-size", type=int, default=2000, help="Number of tracks in each fake library")
+    parser.add_argument("--playlist-size", type=int, default=100, help="Size of playlists and albums")
+    parser.add_argument("--rtt", type=float, default=0.002, help="MPD round trip delay in seconds")
+    parser.add_argument("--spotify-latency", type=float, default=None,
+                        help="Serve Spotify from a fake API with this delay per request, in seconds")
+    parser.add_argument("--verbose", action='store_true', help="Report latency for every room")
+    parser.add_argument("--json", action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+
+    if make_listener(None) is None:
+        parser.error("snipslistener is not installed")
+    if args.recording:
+        messages = load_recording(args.recording)
+    else:
+        messages = generate_recording(args.sites, args.sessions, args.interval)
+
+    results = []
+    # The skill prints its own messages; keep them out of the report.
+    with contextlib.redirect_stdout(sys.stderr):
+        for speed in args.speed:
+            results.append(replay(messages, speed, args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results, args.verbose)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+#! /usr/bin/env python
+# encoding: utf-8
+""" End to end benchmarks of the Mopidy skill against local stand-ins.
+
+Each scenario drives SnipsMopidy (and the listener's intent handlers, when
+snipslistener is installed) against FakeMopidyServer rooms and a
+FakeSpotifyServer, and reports latency percentiles, time to first audio,
+round trips per intent and throughput. Nothing leaves the machine. Run it
+from the repository root.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_mopidy import FakeLibrary, FakeMopidyServer  # noqa: E402
+from benchmarks.fake_spotify import FakeSpotifyServer  # noqa: E402
+from snipsmopidy.snipsmopidy import SnipsMopidy  # noqa: E402
+from snipsmopidy.volume import VOLUME_DEBOUNCE  # noqa: E402
+
+READY_TIMEOUT = 10
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class Bench:
+    """A set of fake rooms, an optional fake Spotify and a skill wired to them."""
+
+    def __init__(self, n_rooms, rtt, library_size, playlist_size, spotify_latency=None, site_ids=None,
+                 **skill_kwargs):
+        library = FakeLibrary(size=library_size, playlist_size=min(playlist_size, library_size))
+        self.rooms = site_ids or ['default'] + ['room{}'.format(i) for i in range(1, n_rooms)]
+        self.servers = [FakeMopidyServer(library, rtt=rtt).start() for _ in self.rooms]
+        self.skill = SnipsMopidy({
+            room: {'host': '127.0.0.1', 'port': server.port} for room, server in zip(self.rooms, self.servers)
+        }, **skill_kwargs)
+        self.spotify = None
+        if spotify_latency is not None:
+            from snipsmopidy.spotify import SpotifyClient
+
+            self.spotify = FakeSpotifyServer(latency=spotify_latency, playlist_size=playlist_size,
+                                             album_size=playlist_size).start()
+            self.skill.spotify = SpotifyClient('refresh-token', 'client-id', 'client-secret',
+                                               api_url=self.spotify.api_url, token_url=self.spotify.token_url)
+        self.wait_ready()
+
+    def wait_ready(self):
+        deadline = time.monotonic() + READY_TIMEOUT
+        while time.monotonic() < deadline:
+            if all(state == 'ready' for state in self.skill.connections.readiness().values()):
+                return
+            time.sleep(0.01)
+        raise RuntimeError("Fake rooms did not become ready: {}".format(self.skill.connections.readiness()))
+
+    def reset(self):
+        for server in self.servers:
+            server.reset_stats()
+        if self.spotify is not None:
+            self.spotify.reset_stats()
+
+    def settle(self):
+        """Wait for background work started by the last intent to finish."""
+        for filler in list(self.skill.queue_fillers.values()):
+            filler.join()
+        time.sleep(VOLUME_DEBOUNCE * 2)
+
+    def close(self):
+        self.skill.connections.close()
+        for server in self.servers:
+            server.stop()
+        if self.spotify is not None:
+            self.spotify.stop()
+
+    def measure(self, name, action, iterations, **labels):
+        """Run ``action(i)`` ``iterations`` times and summarise the measurements."""
+        latencies, first_audio, round_trips, spotify_requests = [], [], [], []
+        for i in range(iterations):
+            self.reset()
+            start = time.monotonic()
+            action(i)
+            latencies.append(time.monotonic() - start)
+            self.settle()
+            played = [s.first_play_at for s in self.servers if s.first_play_at is not None]
+            if played:
+                first_audio.append(min(played) - start)
+            round_trips.append(sum(s.round_trips for s in self.servers))
+            if self.spotify is not None:
+                spotify_requests.append(self.spotify.total_requests)
+        result = {
+            'scenario': name,
+            'iterations': iterations,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'first_audio_p50': percentile(first_audio, 50),
+            'mpd_round_trips': sum(round_trips) / float(iterations),
+            'spotify_requests': sum(spotify_requests) / float(iterations) if spotify_requests else None,
+        }
+        result.update(labels)
+        return result
+
+    def throughput(self, name, action, iterations, **labels):
+        """Run ``action(room, i)`` in every room concurrently and report intents per second."""
+        with ThreadPoolExecutor(len(self.rooms)) as pool:
+            start = time.monotonic()
+            futures = [pool.submit(lambda room: [action(room, i) for i in range(iterations)], room)
+                       for room in self.rooms]
+            for future in futures:
+                future.result()
+            elapsed = time.monotonic() - start
+        result = {'scenario': name, 'intents_per_second': len(self.rooms) * iterations / elapsed}
+        result.update(labels)
+        return result
+
+
+class FakeSlot:
+
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeSessionManager:
+
+    def __init__(self):
+        self.ended_at = None
+
+    def end_session(self, text=None):
+        self.ended_at = time.monotonic()
+
+
+class FakeIntentData:
+    """Looks enough like snipslistener's message data for the intent handlers."""
+
+    def __init__(self, site_id, **slots):
+        self.site_id = site_id
+        self.slots = {name: FakeSlot(value) for name, value in slots.items()}
+        self.session_manager = FakeSessionManager()
+
+
+def make_listener(skill):
+    """A SnipsMopidyListener around ``skill`` without an MQTT connection, or None."""
+    try:
+        from snipsmopidy.snips_listener import SnipsMopidyListener
+    except ImportError:
+        return None
+    listener = SnipsMopidyListener.__new__(SnipsMopidyListener)
+    listener.skill = skill
+    listener.dispatcher = None
+    return listener
+
+
+def skill_scenarios(args, results):
+    for size in args.playlist_sizes:
+        bench = Bench(1, args.rtt, args.library_size, size)
+        try:
+            results.append(bench.measure(
+                'mpd play_playlist', lambda i: bench.skill.play_playlist('default', 'Playlist {}'.format(i % 10)),
+                args.iterations, rooms=1, size=size))
+            results.append(bench.measure(
+                'mpd play_artist', lambda i: bench.skill.play_artist('default', 'artist {}'.format(i % 50)),
+                args.iterations, rooms=1, size=size))
+        finally:
+            bench.close()
+
+        bench = Bench(1, args.rtt, args.library_size, size, spotify_latency=args.spotify_latency)
+        try:
+            results.append(bench.measure(
+                'spotify play_playlist', lambda i: bench.skill.play_playlist('default', 'Mix {}'.format(i)),
+                args.iterations, rooms=1, size=size))
+            results.append(bench.measure(
+                'spotify play_album', lambda i: bench.skill.play_album('default', 'Album {}'.format(i)),
+                args.iterations, rooms=1, size=size))
+            results.append(bench.measure(
+                'spotify play_artist', lambda i: bench.skill.play_artist('default', 'Artist {}'.format(i)),
+                args.iterations, rooms=1, size=size))
+            listener = make_listener(bench.skill)
+            if listener is not None:
+                results.append(bench.measure(
+                    'listener playPlaylist',
+                    lambda i: listener.play_playlist(FakeIntentData('default', playlist_name='Radio {}'.format(i))),
+                    args.iterations, rooms=1, size=size))
+        finally:
+            bench.close()
+
+    bench = Bench(1, args.rtt, args.library_size, 10)
+    try:
+        bench.skill.play_playlist('default', 'Playlist 1')
+
+        def hotword_then_volume_up(i):
+            bench.skill.set_to_low_volume('default')
+            bench.skill.set_to_previous_volume('default')
+            bench.skill.volume_up('default', '1' if i % 2 else None)
+            bench.skill.volume_down('default', '1' if i % 2 else None)
+
+        results.append(bench.measure('hotword + volume', hotword_then_volume_up, args.iterations, rooms=1))
+        results.append(bench.measure('get_info', lambda i: bench.skill.get_info('default'), args.iterations, rooms=1))
+    finally:
+        bench.close()
+
+
+def room_scenarios(args, results):
+    for n_rooms in args.rooms:
+        bench = Bench(n_rooms, args.rtt, args.library_size, 10)
+        try:
+            results.append(bench.measure(
+                'pause everywhere', lambda i: bench.skill.pause('everywhere'), args.iterations, rooms=n_rooms))
+            results.append(bench.throughput(
+                'pause/play per room',
+                lambda room, i: bench.skill.pause(room) if i % 2 else bench.skill.play(room),
+                args.iterations, rooms=n_rooms))
+        finally:
+            bench.close()
+
+
+def format_seconds(value):
+    return '-' if value is None else '{:.1f}ms'.format(value * 1000)
+
+
+def print_report(results):
+    print('{:<24} {:>5} {:>5} {:>9} {:>9} {:>11} {:>8} {:>8} {:>10}'.format(
+        'scenario', 'rooms', 'size', 'p50', 'p99', 'first audio', 'mpd rtt', 'http req', 'intents/s'))
+    for r in results:
+        print('{:<24} {:>5} {:>5} {:>9} {:>9} {:>11} {:>8} {:>8} {:>10}'.format(
+            r['scenario'], r.get('rooms', '-'), r.get('size', '-'),
+            format_seconds(r.get('p50')), format_seconds(r.get('p99')), format_seconds(r.get('first_audio_p50')),
+            '-' if r.get('mpd_round_trips') is None else '{:.1f}'.format(r['mpd_round_trips']),
+            '-' if r.get('spotify_requests') is None else '{:.1f}'.format(r['spotify_requests']),
+            '-' if r.get('intents_per_second') is None else '{:.0f}'.format(r['intents_per_second'])))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20, help="Intents per scenario")
+    parser.add_argument("--rooms", type=int_list, default=[1, 4], help="Room counts, e.g. 1,4,8")
+    parser.add_argument("--playlist-sizes", type=int_list, default=[10, 100, 1000],
+                        help="Playlist and album sizes, e.g. 10,100")
+    parser.add_argument("--library-size", type=int, default=2000, help="Number of tracks in each fake library")
+    parser.add_argument("--rtt", type=float, default=0.002, help="MPD round trip delay in seconds")
+    parser.add_argument("--spotify-latency", type=float, default=0.02, help="Spotify request delay in seconds")
+    parser.add_argument("--json", action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    # The skill prints its own messages; keep them out of the report.
+    with contextlib.redirect_stdout(sys.stderr):
+        skill_scenarios(args, results)
+        room_scenarios(args, results)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
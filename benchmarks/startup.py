@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+# encoding: utf-8
+""" Measure the cold start time of the Mopidy skill.
+
+Each run starts a fresh interpreter which imports the skill and builds a
+SnipsMopidy for rooms that cannot be reached, so the result shows whether
+an offline room or a heavy import holds up startup. Run it from the
+repository root.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+# Cold start budget for a Raspberry Pi-class device, in seconds.
+STARTUP_BUDGET = 1.5
+
+STARTUP_SCRIPT = """
+import sys
+import time
+start = time.monotonic()
+from snipsmopidy.snipsmopidy import SnipsMopidy
+skill = SnipsMopidy({rooms!r}, lazy_connect={lazy!r})
+elapsed = time.monotonic() - start
+heavy = [name for name in ('fuzzywuzzy', 'requests', 'http.server') if name in sys.modules]
+print(elapsed, ','.join(heavy))
+"""
+
+
+def measure(n_rooms, lazy):
+    # Port 1 refuses connections, like a room whose Mopidy is down.
+    rooms = {'room{}'.format(i): {'host': '127.0.0.1', 'port': 1} for i in range(n_rooms)}
+    rooms['default'] = rooms.pop('room0')
+    out = subprocess.check_output(
+        [sys.executable, '-c', STARTUP_SCRIPT.format(rooms=rooms, lazy=lazy)],
+        stderr=subprocess.DEVNULL, universal_newlines=True)
+    fields = out.split()
+    return float(fields[0]), fields[1] if len(fields) > 1 else ''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10, help="Number of cold starts to measure")
+    parser.add_argument("--rooms", type=int, default=3, help="Number of (offline) rooms to configure")
+    parser.add_argument("--lazy", action='store_true', help="Connect rooms on first use")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET, help="Startup budget in seconds")
+    args = parser.parse_args()
+
+    timings = []
+    heavy = ''
+    for _ in range(args.runs):
+        elapsed, heavy = measure(args.rooms, args.lazy)
+        timings.append(elapsed)
+    median = statistics.median(timings)
+    print("startup over {} runs: median {:.3f}s, max {:.3f}s (budget {:.3f}s)".format(
+        args.runs, median, max(timings), args.budget))
+    if heavy:
+        print("imported during startup: {}".format(heavy))
+    if median > args.budget:
+        print("startup is over budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,9 @@
 
 import argparse
 
-from snipssonos.spotify import SpotifyClient
+from snipsmopidy.export import FavouritesExporter
+from snipsmopidy.spotify import SpotifyClient
+from snipsmopidy.spotify_cache import SearchCache
 
 SNIPS_SPOTIFY_APP_URL = "https://snips-spotify-login.herokuapp.com/"
 
@@ -15,6 +17,8 @@ def main():
         help="Spotify refresh token. Get one from {}".format(
             SNIPS_SPOTIFY_APP_URL)
     )
+    parser.add_argument("client_id", help="Client id of the Spotify application")
+    parser.add_argument("client_secret", help="Client secret of the Spotify application")
     parser.add_argument(
         "artist_file",
         help="Name of file to dump favorite artists (e.g. artists.txt)"
@@ -27,14 +31,34 @@ def main():
         "playlist_file",
         help="Name of file to dump favorite playlists (e.g. playlists.txt)"
     )
+    parser.add_argument("--album-file", help="Name of file to dump albums (e.g. albums.txt)")
+    parser.add_argument(
+        "--cache",
+        help="Search cache database to fill with the exported items, as used by the skill"
+    )
+    parser.add_argument(
+        "--snapshot",
+        help="Favourites snapshot file to write, as used by the skill to find favourites without a search"
+    )
+    parser.add_argument("--no-saved-tracks", action='store_true', help="Leave out the saved tracks")
+    parser.add_argument("--no-playlist-tracks", action='store_true', help="Leave out the tracks of playlists")
     args = parser.parse_args()
-    client = SpotifyClient(args.spotify_refresh_token)
-    print "Dumping favorite artists to {}".format(args.artist_file)
-    client.dump_favorite('artists', float("Inf"), args.artist_file)
-    print "Dumping favorite tracks to {}".format(args.track_file)
-    client.dump_favorite('tracks', float("Inf"), args.track_file)
-    print "Dumping favorite playlists to {}".format(args.playlist_file)
-    client.dump_playlists(args.playlist_file)
+    client = SpotifyClient(args.spotify_refresh_token, args.client_id, args.client_secret,
+                           search_cache=SearchCache(args.cache) if args.cache else None)
+    print("Dumping favorite artists, tracks and playlists to {}, {} and {}".format(
+        args.artist_file, args.track_file, args.playlist_file))
+    counts = FavouritesExporter(client).export(
+        artists=args.artist_file,
+        tracks=args.track_file,
+        albums=args.album_file,
+        playlists=args.playlist_file,
+        saved_tracks=not args.no_saved_tracks,
+        playlist_tracks=not args.no_playlist_tracks,
+        seed_cache=args.cache is not None,
+        snapshot=args.snapshot,
+    )
+    for kind, count in sorted(counts.items()):
+        print("{} {}s".format(count, kind))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,95 @@
+# -*-: coding utf-8 -*-
+""" Keeps a room's queue from running out while it plays. """
+
+from __future__ import unicode_literals
+import logging
+import threading
+
+from .playqueue import run_command_list
+from .resume import queue_uris
+
+LOG = logging.getLogger(__name__)
+
+# Related tracks are appended once fewer than this many songs follow the current one.
+AUTOPLAY_THRESHOLD = 3
+# Most related tracks appended at once.
+AUTOPLAY_BATCH = 10
+
+
+def remaining(snapshot):
+    """The number of songs queued after the current one, or None when nothing is playing."""
+    if snapshot is None or snapshot.state != 'play' or snapshot.song is None:
+        return None
+    return snapshot.queue_length - int(snapshot.song.get('pos', 0)) - 1
+
+
+class RoomAutoplay:
+    """Appends related tracks to a room's queue before it runs out.
+
+    The room's RoomState tells when fewer than AUTOPLAY_THRESHOLD songs are
+    left; tracks related to the current song are then fetched and appended
+    in the background, so "next" always has a song to go to and playback
+    does not stop at the end of the queue. Nothing is appended while the
+    queue repeats, and tracks already queued are skipped.
+
+    :param connections: The MopidyConnectionManager to take connections from
+    :param player: The RoomState of the room
+    :param related: ``related(song, client)`` gives URIs of tracks related to a ``currentsong``
+        dict, or None if the queue should not be extended yet
+    """
+
+    def __init__(self, connections, player, related):
+        self.connections = connections
+        self.player = player
+        self.room = player.room
+        self.related = related
+        self._lock = threading.Lock()
+        self._extending = False
+        # The song the queue was last extended for, so it is extended once per song.
+        self._extended_for = None
+        player.subscribe(self._on_state)
+
+    def _on_state(self, snapshot):
+        left = remaining(snapshot)
+        if left is None or left >= AUTOPLAY_THRESHOLD or snapshot.repeat:
+            return
+        with self._lock:
+            if self._extending or self._extended_for == snapshot.song.get('id'):
+                return
+            self._extending = True
+
+        def extend():
+            try:
+                self.extend(snapshot.song)
+            except Exception:
+                LOG.exception("Extending the queue of %s failed", self.room)
+            finally:
+                with self._lock:
+                    self._extending = False
+        threading.Thread(target=extend, name="autoplay-{}".format(self.room), daemon=True).start()
+
+    def extend(self, song, client=None):
+        """Append up to AUTOPLAY_BATCH tracks related to ``song`` now.
+
+        :param client: The connection to the room to use, or None to take one from the pool
+        :return: The number of tracks appended
+        """
+        if client is None:
+            with self.connections.connection(self.room) as client:
+                return self.extend(song, client)
+        uris = self.related(song, client)
+        if uris is None:
+            return 0
+        with self._lock:
+            self._extended_for = song.get('id')
+        queued = set(queue_uris(client))
+        batch = []
+        for uri in uris:
+            if uri not in queued:
+                queued.add(uri)
+                batch.append(uri)
+                if len(batch) == AUTOPLAY_BATCH:
+                    break
+        failed = run_command_list(client, [('add', uri) for uri in batch])
+        LOG.debug("Appended %d related tracks to the queue of %s", len(batch) - len(failed), self.room)
+        return len(batch) - len(failed)
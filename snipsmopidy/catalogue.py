@@ -0,0 +1,95 @@
+# -*-: coding utf-8 -*-
+""" Local catalogue of a Mopidy library's tags. """
+
+from __future__ import unicode_literals
+import logging
+import sys
+import threading
+
+from .index import normalise
+from .resolver import FUZZ_RATIO, EntityResolver
+
+LOG = logging.getLogger(__name__)
+
+CATALOGUE_TAGS = ('artist', 'album', 'title')
+
+
+def _tag_values(client, tag):
+    values = set()
+    for item in client.list(tag):
+        # python-mpd2 returns dicts since 1.0, plain strings before that.
+        value = item.get(tag) if isinstance(item, dict) else item
+        if value:
+            values.add(sys.intern(value))
+    return frozenset(values)
+
+
+class TagCatalogue:
+    """The values of one tag, by normalised name."""
+
+    def __init__(self, values):
+        self.values = values
+        self.exact = {}
+        for value in values:
+            self.exact.setdefault(normalise(value), value)
+
+
+class LibraryCatalogue:
+    """Artist, album and title tags of one room's library, held in memory.
+
+    The catalogue is loaded in the background and reloaded on ``idle
+    database`` events; only tags whose set of values changed are re-indexed.
+    Values are indexed in an EntityResolver, with the room as their source.
+
+    :param connections: The MopidyConnectionManager to take connections from
+    :param room: The room whose library is catalogued
+    :param resolver: The EntityResolver to index the values in, or None for one of its own
+    """
+
+    def __init__(self, connections, room, tags=CATALOGUE_TAGS, resolver=None):
+        self.connections = connections
+        self.room = room
+        self.tags = tags
+        self.resolver = resolver if resolver is not None else EntityResolver()
+        self.catalogues = {}
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+        watcher = connections.get_watcher(room)
+        watcher.subscribe(self._on_database, 'database')
+        if watcher.connected.is_set():
+            # The watcher only announces its subscriptions when it (re)connects.
+            threading.Thread(target=self._on_database, args=('database',), daemon=True).start()
+
+    def _on_database(self, subsystem):
+        try:
+            self.reload()
+        except Exception:
+            LOG.exception("Loading the library catalogue for %s failed", self.room)
+
+    def reload(self):
+        with self._lock:
+            with self.connections.connection(self.room) as client:
+                fetched = {tag: _tag_values(client, tag) for tag in self.tags}
+            for tag, values in fetched.items():
+                current = self.catalogues.get(tag)
+                if current is None or current.values != values:
+                    self.catalogues[tag] = TagCatalogue(values)
+                    self.resolver.update(self.room, tag, values)
+            self.ready.set()
+        LOG.info("Catalogued %s for %s",
+                 ", ".join("{} {}s".format(len(self.catalogues[tag].values), tag) for tag in self.tags),
+                 self.room)
+
+    def resolve(self, tag, name):
+        """The exact tag value matching a spoken name, or None.
+
+        Matching ignores case and accents and falls back to fuzzy and
+        phonetic matching.
+        """
+        if tag not in self.catalogues:
+            return None
+        value = self.catalogues[tag].exact.get(normalise(name))
+        if value is not None:
+            return value
+        match = self.resolver.best(name, tag, sources=(self.room,), min_score=FUZZ_RATIO)
+        return match.value if match is not None else None
@@ -0,0 +1,281 @@
+# -*-: coding utf-8 -*-
+""" Pooled, health-checked connections to Mopidy instances. """
+
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from mpd import MPDClient
+from mpd import ConnectionError
+
+from .metrics import TimedClient
+
+LOG = logging.getLogger(__name__)
+
+MPD_PORT = 6600
+POOL_SIZE = 2
+# Socket timeout for a single MPD command, in seconds.
+COMMAND_TIMEOUT = 5
+# Longest time an intent handler waits for a usable connection, in seconds.
+ACQUIRE_TIMEOUT = 3
+KEEPALIVE_INTERVAL = 20
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+
+class MopidyUnavailable(Exception):
+    """Raised when no connection to a room's Mopidy could be made in time.
+
+    :param room: The room whose Mopidy is unavailable
+    """
+
+    def __init__(self, room, host):
+        super().__init__("No connection to Mopidy on {} for room {}".format(host, room))
+        self.room = room
+
+
+class RoomConnectionPool:
+    """A small pool of MPD connections to one Mopidy instance.
+
+    Idle connections are pinged in the background so that a connection handed
+    out to an intent handler is already known to be alive. Broken connections
+    are replaced with a bounded exponential backoff between attempts.
+
+    :param site_id: The room this pool serves
+    :param host: The hostname of the Mopidy player
+    :param port: The MPD port of the Mopidy player
+    :param lazy: Whether to wait for the first use before connecting
+    """
+
+    def __init__(self, site_id, host, port=MPD_PORT, size=POOL_SIZE,
+                 command_timeout=COMMAND_TIMEOUT, keepalive_interval=KEEPALIVE_INTERVAL, lazy=False):
+        self.site_id = site_id
+        self.host = host
+        self.port = port
+        self.size = size
+        self.command_timeout = command_timeout
+        self.keepalive_interval = keepalive_interval
+
+        self._idle = []
+        self._n_open = 0
+        self._cond = threading.Condition()
+        self._backoff = MIN_BACKOFF
+        self._next_attempt = 0
+        self._closed = False
+        self._connecting = False
+        self._failed = False
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(
+            target=self._maintain, name="mopidy-pool-{}".format(site_id), daemon=True)
+        if not lazy:
+            self.start()
+
+    def start(self):
+        """Start connecting in the background, if not already started."""
+        with self._cond:
+            if self._thread.ident is not None or self._closed:
+                return
+            self._thread.start()
+
+    @property
+    def state(self):
+        """'idle' before the first use of a lazy pool, then 'connecting', 'ready' or 'unavailable'."""
+        with self._cond:
+            if self._thread.ident is None:
+                return 'idle'
+            if self._n_open - self._connecting > 0:
+                return 'ready'
+            return 'unavailable' if self._failed else 'connecting'
+
+    def _connect(self):
+        client = MPDClient()
+        client.timeout = self.command_timeout
+        client.connect(self.host, self.port)
+        return client
+
+    def _try_connect(self):
+        """Make one connection attempt, honouring the current backoff.
+
+        Returns the new client, or None if the attempt failed or is not due yet.
+        """
+        now = time.monotonic()
+        if now < self._next_attempt:
+            return None
+        self._connecting = True
+        try:
+            client = self._connect()
+        except Exception as e:
+            LOG.warning("Mopidy is not yet available on %s (%s), retrying in %.1fs",
+                        self.host, e, self._backoff)
+            self._failed = True
+            self._next_attempt = time.monotonic() + self._backoff
+            self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+            return None
+        finally:
+            self._connecting = False
+        self._failed = False
+        self._backoff = MIN_BACKOFF
+        self._next_attempt = 0
+        return client
+
+    def _maintain(self):
+        while not self._closed:
+            self._check_idle()
+            self._fill()
+            if self._n_open < self.size:
+                delay = max(self._next_attempt - time.monotonic(), MIN_BACKOFF)
+            else:
+                delay = self.keepalive_interval
+            self._wakeup.wait(min(delay, self.keepalive_interval))
+            self._wakeup.clear()
+
+    def _check_idle(self):
+        with self._cond:
+            to_check = list(self._idle)
+        for client in to_check:
+            # Take connections out one at a time so acquire() is never starved.
+            with self._cond:
+                if client not in self._idle:
+                    continue
+                self._idle.remove(client)
+            try:
+                client.ping()
+            except (ConnectionError, OSError):
+                self._discard(client)
+            else:
+                self._put_back(client)
+
+    def _fill(self):
+        while not self._closed:
+            with self._cond:
+                if self._n_open >= self.size:
+                    return
+                self._n_open += 1
+            client = self._try_connect()
+            if client is None:
+                with self._cond:
+                    self._n_open -= 1
+                return
+            self._put_back(client)
+
+    def _put_back(self, client):
+        with self._cond:
+            self._idle.append(client)
+            self._cond.notify()
+
+    def _discard(self, client):
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+        with self._cond:
+            self._n_open -= 1
+        self._wakeup.set()
+
+    def acquire(self, timeout=ACQUIRE_TIMEOUT):
+        """Take a live connection from the pool.
+
+        Waits at most ``timeout`` seconds before raising MopidyUnavailable.
+        """
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._idle:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise MopidyUnavailable(self.site_id, self.host)
+                self._wakeup.set()
+                self._cond.wait(remaining)
+            return self._idle.pop()
+
+    def warm(self):
+        """Check idle connections and open missing ones now, in the background."""
+        self.start()
+        self._wakeup.set()
+
+    def release(self, client, broken=False):
+        if broken or self._closed:
+            self._discard(client)
+        else:
+            self._put_back(client)
+
+    @contextmanager
+    def connection(self, timeout=ACQUIRE_TIMEOUT):
+        client = self.acquire(timeout)
+        try:
+            yield TimedClient(client, self.site_id)
+        except (ConnectionError, OSError):
+            self.release(client, broken=True)
+            raise
+        except BaseException:
+            self.release(client)
+            raise
+        else:
+            self.release(client)
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            self._discard(client)
+
+
+class MopidyConnectionManager:
+    """Keeps one RoomConnectionPool per configured room.
+
+    :param mopidy_rooms: Mapping of site_id to ``{'host': ..., 'port': ...}``;
+        entries without a host (room groups) are skipped
+    """
+
+    def __init__(self, mopidy_rooms, acquire_timeout=ACQUIRE_TIMEOUT, **pool_kwargs):
+        self.acquire_timeout = acquire_timeout
+        self.mopidy_rooms = mopidy_rooms
+        self.watchers = {}
+        self._watchers_lock = threading.Lock()
+        self.pools = {
+            site_id: RoomConnectionPool(
+                site_id, details['host'], details.get('port', MPD_PORT), **pool_kwargs)
+            for site_id, details in mopidy_rooms.items() if 'host' in details
+        }
+
+    def room(self, site_id):
+        """The configured room serving ``site_id``."""
+        if site_id in self.pools:
+            return site_id
+        else:
+            return 'default'
+
+    def get_pool(self, site_id):
+        return self.pools[self.room(site_id)]
+
+    def readiness(self):
+        """The connection state of every room's pool."""
+        return {site_id: pool.state for site_id, pool in self.pools.items()}
+
+    def get_watcher(self, site_id):
+        """The RoomEventWatcher of a room, created on first use."""
+        from .events import RoomEventWatcher
+
+        room = self.room(site_id)
+        with self._watchers_lock:
+            if room not in self.watchers:
+                details = self.mopidy_rooms[room]
+                self.watchers[room] = RoomEventWatcher(
+                    room, details['host'], details.get('port', MPD_PORT))
+            return self.watchers[room]
+
+    def subscribe(self, site_id, callback, *subsystems):
+        self.get_watcher(site_id).subscribe(callback, *subsystems)
+
+    def connection(self, site_id):
+        return self.get_pool(site_id).connection(self.acquire_timeout)
+
+    def close(self):
+        for watcher in self.watchers.values():
+            watcher.close()
+        for pool in self.pools.values():
+            pool.close()
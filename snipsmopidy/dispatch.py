@@ -0,0 +1,109 @@
+# -*-: coding utf-8 -*-
+""" Per-room serialization of skill commands on an asyncio loop. """
+
+from __future__ import unicode_literals
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial, wraps
+import logging
+import threading
+import time
+
+from .metrics import traced
+
+LOG = logging.getLogger(__name__)
+
+
+class RoomDispatcher:
+    """Runs commands in order per room, and concurrently across rooms.
+
+    Each site_id gets an asyncio queue drained by its own worker coroutine on
+    a loop running in a background thread. The skill's MPD calls block, so a
+    worker runs them in a thread pool; a slow Mopidy in one room then only
+    delays that room's queue.
+    """
+
+    def __init__(self, max_workers=None):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="room-worker")
+        self.queues = {}
+        self._workers = []
+        self._thread = threading.Thread(target=self._run, name="room-dispatcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, site_id, fn, *args, **kwargs):
+        """Queue ``fn(*args, **kwargs)`` behind earlier commands for ``site_id``.
+
+        Can be called from any thread.
+
+        :return: A concurrent.futures.Future for the result
+        """
+        future = Future()
+        self.loop.call_soon_threadsafe(self._enqueue, site_id, partial(fn, *args, **kwargs), future)
+        return future
+
+    def _enqueue(self, site_id, call, future):
+        queue = self.queues.get(site_id)
+        if queue is None:
+            queue = self.queues[site_id] = asyncio.Queue()
+            self._workers.append(self.loop.create_task(self._worker(site_id, queue)))
+        queue.put_nowait((call, future))
+
+    async def _worker(self, site_id, queue):
+        while True:
+            call, future = await queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = await self.loop.run_in_executor(self.executor, call)
+            except Exception as e:
+                LOG.exception("Command for %s failed", site_id)
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def queue_depth(self, site_id):
+        queue = self.queues.get(site_id)
+        return queue.qsize() if queue is not None else 0
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop)
+        self._thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=False)
+
+    async def _stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self.loop.stop()
+
+
+def per_room(fn):
+    """Run a listener handler on the queue of the room it acts on when the listener has a dispatcher.
+
+    The room comes from the listener's ``dispatch_room(data)``, so a command
+    spoken in one room for another stays in order with the other room's
+    commands. The time from receiving the message to finishing the handler
+    is recorded in the intent latency histogram, labelled with that room.
+    Apply it beneath the ``@intent``/``@hotword_detected``/``@session_ended``
+    decorator.
+
+    :return: The handler's result, or a Future for it when it was queued
+    """
+    @wraps(fn)
+    def wrapper(self, data):
+        received = time.monotonic()
+        room = self.dispatch_room(data)
+
+        def handle():
+            with traced(fn.__name__, room, received):
+                return fn(self, data)
+        if self.dispatcher is None:
+            return handle()
+        return self.dispatcher.submit(room, handle)
+    return wrapper
@@ -0,0 +1,105 @@
+# -*-: coding utf-8 -*-
+""" MPD idle event dispatch. """
+
+from __future__ import unicode_literals
+from collections import defaultdict
+import logging
+import socket
+import threading
+import time
+
+from mpd import MPDClient
+
+from .connection import COMMAND_TIMEOUT, MAX_BACKOFF, MIN_BACKOFF
+
+LOG = logging.getLogger(__name__)
+
+
+class RoomEventWatcher(threading.Thread):
+    """Waits on a dedicated MPD connection for ``idle`` events of one room.
+
+    Callbacks are called with the name of the changed subsystem, on the
+    watcher thread, once per wake-up even if several of their subsystems
+    changed. After every (re)connection every callback is called once, since
+    events may have been missed.
+
+    :param site_id: The room to watch
+    :param host: The hostname of the Mopidy player
+    :param port: The MPD port of the Mopidy player
+    """
+
+    def __init__(self, site_id, host, port):
+        super().__init__(name="mopidy-idle-{}".format(site_id), daemon=True)
+        self.site_id = site_id
+        self.host = host
+        self.port = port
+        self.connected = threading.Event()
+        self._subscribers = defaultdict(list)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._running = False
+        self._client = None
+
+    def subscribe(self, callback, *subsystems):
+        with self._lock:
+            for subsystem in subsystems:
+                self._subscribers[subsystem].append(callback)
+            start = not self._running and not self._closed
+            self._running = True
+        if start:
+            self.start()
+
+    def _dispatch(self, subsystems):
+        # A callback subscribed to several of the changed subsystems is only called once.
+        calls = []
+        with self._lock:
+            for subsystem in subsystems:
+                for callback in self._subscribers.get(subsystem, ()):
+                    if all(callback != called for called, _ in calls):
+                        calls.append((callback, subsystem))
+        for callback, subsystem in calls:
+            try:
+                callback(subsystem)
+            except Exception:
+                LOG.exception("Handling MPD %s event for %s failed", subsystem, self.site_id)
+
+    def run(self):
+        backoff = MIN_BACKOFF
+        while not self._closed:
+            client = MPDClient()
+            client.timeout = COMMAND_TIMEOUT
+            try:
+                client.connect(self.host, self.port)
+                self._client = client
+                self.connected.set()
+                backoff = MIN_BACKOFF
+                with self._lock:
+                    subsystems = list(self._subscribers)
+                self._dispatch(subsystems)
+                while not self._closed:
+                    self._dispatch(client.idle())
+            except Exception as e:
+                if self._closed:
+                    return
+                LOG.warning("Lost MPD idle connection to %s (%s), retrying in %.1fs",
+                            self.host, e, backoff)
+            finally:
+                self.connected.clear()
+                self._client = None
+                try:
+                    client.disconnect()
+                except Exception:
+                    pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def close(self):
+        self._closed = True
+        client = self._client
+        if client is not None:
+            # Closing the client here would block on the idle read holding its
+            # buffer; shutting the socket down wakes it, and run() disconnects.
+            try:
+                client._sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
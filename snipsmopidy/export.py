@@ -0,0 +1,244 @@
+# -*-: coding utf-8 -*-
+""" Export of a Spotify user's library to entity files and the search cache. """
+
+from __future__ import unicode_literals
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+import csv
+import io
+import logging
+import threading
+
+from .index import normalise
+from .ratelimit import SpotifyThrottled
+from .snapshot import SnapshotWriter
+from .spotify import HTTP_POOL_SIZE, SEARCHES
+
+LOG = logging.getLogger(__name__)
+
+TIME_RANGES = ('long_term', 'medium_term', 'short_term')
+# Page sizes are the maximum each endpoint allows.
+TOP_PAGE_SIZE = 50
+SAVED_PAGE_SIZE = 50
+PLAYLISTS_PAGE_SIZE = 50
+PLAYLIST_TRACKS_PAGE_SIZE = 100
+# Pages fetched at once across all endpoints; more than the HTTP pool would open throwaway connections.
+EXPORT_WORKERS = HTTP_POOL_SIZE
+
+
+class EntityWriter:
+    """Writes distinct names to an entity file as they arrive, one per line.
+
+    Names are compared in their normalised form, so only the first spelling
+    of a name is kept. Lines are CSV, as a comma in a Snips entity value
+    would otherwise start a synonym.
+
+    :param path: The file to write, or None to only count the names
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.count = 0
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._file = io.open(path, 'w', encoding='utf-8', newline='') if path is not None else None
+        self._csv = csv.writer(self._file, lineterminator='\n') if self._file is not None else None
+
+    def add_all(self, names):
+        with self._lock:
+            for name in names:
+                if not name:
+                    continue
+                key = normalise(name)
+                if key in self._seen:
+                    continue
+                self._seen.add(key)
+                self.count += 1
+                if self._csv is not None:
+                    self._csv.writerow([name])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class FavouritesExporter:
+    """Fetches a user's top items, saved tracks and playlists into entity files.
+
+    Every page of every endpoint is fetched by one pool of EXPORT_WORKERS
+    threads: the first page of each endpoint gives its total, after which its
+    other pages are queued, and each playlist found queues its tracks. Pages
+    are written out as they arrive, so memory only holds the names already
+    seen. Artists, albums and playlists found are also put in the client's
+    search cache, so asking for them later needs no search; tracks are left
+    out, as a library's worth of them would push everything else out.
+
+    Everything found can also be written to a FavouritesSnapshot. Given the
+    previous snapshot, the tracks of playlists whose snapshot_id has not
+    changed are taken from it instead of being fetched again.
+
+    :param client: The SpotifyClient to fetch with
+    """
+
+    def __init__(self, client, workers=EXPORT_WORKERS):
+        self.client = client
+        self.workers = workers
+        self.failed_pages = 0
+        self.writers = {}
+        self.seed_cache = True
+        self.top_limit = None
+        self.snapshot = None
+        self._previous_playlists = {}
+        self._previous_entries = {}
+        self._lock = threading.Lock()
+
+    def export(self, artists=None, tracks=None, albums=None, playlists=None,
+               top=True, saved_tracks=True, playlist_tracks=True, top_limit=None, seed_cache=True,
+               snapshot=None, previous=None):
+        """Write the user's names of each kind to the given files.
+
+        :param top: Include the top artists and tracks of every time range
+        :param saved_tracks: Include the saved tracks, their artists and albums
+        :param playlist_tracks: Include the tracks, artists and albums of every user playlist
+        :param top_limit: Most top items fetched per time range, or None for all of them
+        :param seed_cache: Put the items found in the client's search cache
+        :param snapshot: The file to write a FavouritesSnapshot of the items found to
+        :param previous: The FavouritesSnapshot to take the tracks of unchanged playlists from
+        :return: The number of distinct names of each kind
+        """
+        self.writers = {
+            'artist': EntityWriter(artists),
+            'track': EntityWriter(tracks),
+            'album': EntityWriter(albums),
+            'playlist': EntityWriter(playlists),
+        }
+        self.seed_cache = seed_cache
+        self.top_limit = top_limit
+        self.failed_pages = 0
+        self.snapshot = SnapshotWriter() if snapshot is not None else None
+        self._index_previous(previous)
+        api = self.client.session.api
+        sources = []
+        if top:
+            for time_range in TIME_RANGES:
+                params = {'time_range': time_range}
+                if artists is not None or seed_cache or snapshot is not None:
+                    sources.append((api('v1/me/top/artists'), TOP_PAGE_SIZE, params, self._on_artists, True))
+                sources.append((api('v1/me/top/tracks'), TOP_PAGE_SIZE, params, self._on_tracks, True))
+        if saved_tracks:
+            sources.append((api('v1/me/tracks'), SAVED_PAGE_SIZE, None, self._on_saved_tracks, False))
+        if playlists is not None or playlist_tracks or snapshot is not None:
+            sources.append((api('v1/me/playlists'), PLAYLISTS_PAGE_SIZE, None,
+                            self._on_playlists if playlist_tracks else self._on_playlist_names, False))
+        try:
+            self._run(sources)
+        finally:
+            for writer in self.writers.values():
+                writer.close()
+        if self.failed_pages:
+            LOG.warning("Could not fetch %d pages, the export is incomplete", self.failed_pages)
+        elif self.snapshot is not None:
+            # An incomplete snapshot would lose favourites until the next export, keep the previous one.
+            self.snapshot.write(snapshot)
+        return {kind: writer.count for kind, writer in self.writers.items()}
+
+    def _index_previous(self, previous):
+        self._previous_playlists = {}
+        self._previous_entries = {}
+        if previous is None or self.snapshot is None:
+            return
+        for entry in previous.entries():
+            if entry.kind == 'playlist' and not entry.source:
+                self._previous_playlists[entry.id] = entry.snapshot_id
+            if entry.source:
+                self._previous_entries.setdefault(entry.source, []).append(entry)
+
+    def _run(self, sources):
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="spotify-export") as pool:
+            pending = {pool.submit(self._fetch, source, 0) for source in sources}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for source, offset in future.result():
+                        pending.add(pool.submit(self._fetch, source, offset))
+
+    def _fetch(self, source, offset):
+        """Fetch and write one page.
+
+        :return: The ``(source, offset)`` pages to fetch next
+        """
+        url, limit, params, on_items, is_top = source
+        try:
+            page = self.client.get_page(url, limit, offset, params)
+        except SpotifyThrottled:
+            page = None
+        if page is None:
+            with self._lock:
+                self.failed_pages += 1
+            return []
+        follow_up = on_items(page['items']) or []
+        if offset == 0:
+            total = page.get('total', 0)
+            if is_top and self.top_limit is not None:
+                total = min(total, self.top_limit)
+            follow_up.extend((source, next_offset) for next_offset in range(limit, int(total), limit))
+        return follow_up
+
+    def _cache(self, search_type, items):
+        if self.seed_cache:
+            items = [(item['name'], item) for item in items if item.get('name') and item.get('id')]
+            if items:
+                self.client.search_cache.put_many(search_type, items)
+                for name, _ in items:
+                    self.client.resolver.add(SEARCHES, search_type, name)
+
+    def _snapshot(self, kind, items, source=''):
+        if self.snapshot is not None:
+            self.snapshot.add(kind, items, source)
+
+    def _on_artists(self, artists):
+        self.writers['artist'].add_all(artist.get('name') for artist in artists)
+        self._cache('artist', artists)
+        self._snapshot('artist', artists)
+
+    def _on_tracks(self, tracks, source=''):
+        tracks = [track for track in tracks if track]
+        artists = [artist for track in tracks for artist in track.get('artists', ())]
+        albums = [track['album'] for track in tracks if track.get('album')]
+        self.writers['track'].add_all(track.get('name') for track in tracks)
+        self.writers['artist'].add_all(artist.get('name') for artist in artists)
+        self.writers['album'].add_all(album.get('name') for album in albums)
+        self._cache('artist', artists)
+        self._cache('album', albums)
+        self._snapshot('track', tracks, source)
+        self._snapshot('artist', artists, source)
+        self._snapshot('album', albums, source)
+
+    def _on_saved_tracks(self, items, source=''):
+        # Tracks which are no longer available have no track object.
+        self._on_tracks([item.get('track') for item in items], source)
+
+    def _on_playlist_names(self, playlists):
+        self.writers['playlist'].add_all(playlist.get('name') for playlist in playlists)
+        self._cache('playlist', playlists)
+        self._snapshot('playlist', playlists)
+
+    def _on_playlists(self, playlists):
+        self._on_playlist_names(playlists)
+        follow_up = []
+        for playlist in playlists:
+            href = playlist.get('tracks', {}).get('href')
+            if not href:
+                continue
+            snapshot_id = playlist.get('snapshot_id')
+            if snapshot_id and self._previous_playlists.get(playlist['id']) == snapshot_id:
+                self._reuse(self._previous_entries.get(playlist['id'], []))
+                continue
+            on_items = partial(self._on_saved_tracks, source=playlist['id'])
+            follow_up.append(((href, PLAYLIST_TRACKS_PAGE_SIZE, None, on_items, False), 0))
+        return follow_up
+
+    def _reuse(self, entries):
+        for entry in entries:
+            self.writers[entry.kind].add_all((entry.name,))
+        self.snapshot.add_entries(entries)
@@ -0,0 +1,208 @@
+# -*-: coding utf-8 -*-
+""" Local fuzzy name lookup. """
+
+from __future__ import unicode_literals
+from collections import Counter, defaultdict
+import re
+import unicodedata
+
+NGRAM = 3
+# Number of prefiltered candidates which are scored with fuzz.
+MAX_CANDIDATES = 20
+
+_NON_WORD = re.compile(r'[\W_]+', re.UNICODE)
+
+_NUMBER_WORDS = {
+    word: value for value, word in enumerate((
+        'zero one two three four five six seven eight nine ten eleven twelve thirteen '
+        'fourteen fifteen sixteen seventeen eighteen nineteen').split())
+}
+_NUMBER_WORDS.update(
+    (word, 10 * value) for value, word in enumerate('twenty thirty forty fifty sixty seventy eighty ninety'.split(), 2))
+_SCALES = {'hundred': 100, 'thousand': 1000}
+
+
+def _room(value):
+    """The values which can still be added to a spoken number ending in ``value``: units after tens."""
+    return 10 if value >= 20 and value % 10 == 0 else 0
+
+
+def _spoken_numbers(tokens):
+    """Replace spelled-out numbers by their digits.
+
+    Numbers said in pairs of digits run together, as they are written: "one
+    eighty two" and "one hundred eighty two" are both 182, "twenty twenty"
+    is 2020, but "one two three" stays 1 2 3.
+    """
+    result = []
+    reading = False
+    for token in tokens:
+        value = _NUMBER_WORDS.get(token)
+        if reading:
+            # The number read so far is ``digits`` followed by base + small.
+            if token in _SCALES:
+                if token == 'thousand':
+                    base, small = (base + small or 1) * 1000, 0
+                else:
+                    small = (small or 1) * 100
+                room = _SCALES[token]
+                continue
+            if value is not None and value < room:
+                small += value
+                room = _room(value)
+                continue
+            digits += str(base + small)
+            if value is not None and value >= 10:
+                base, small, room = 0, value, _room(value)
+                continue
+            result.append(digits)
+            reading = False
+        if value is None:
+            result.append(token)
+        else:
+            reading, digits, base, small, room = True, '', 0, value, _room(value)
+    if reading:
+        result.append(digits + str(base + small))
+    return result
+
+
+def words(name):
+    """The words of ``name``, lower-cased and without accents or punctuation.
+
+    Spelled-out numbers are given in digits, as speech recognition spells
+    out "Maroon 5" and "Blink-182".
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return _spoken_numbers(_NON_WORD.sub(' ', name.lower()).split())
+
+
+def normalise(name):
+    """Lower-case ``name``, strip accents and punctuation and sort its tokens."""
+    return ' '.join(sorted(words(name)))
+
+
+_VOWELS = frozenset('AEIOU')
+_FRONT_VOWELS = frozenset('EIY')
+_INITIAL_EXCEPTIONS = {'AE': 'E', 'GN': 'N', 'KN': 'N', 'PN': 'N', 'WR': 'R', 'WH': 'W'}
+_SAME = {'F': 'F', 'J': 'J', 'L': 'L', 'M': 'M', 'N': 'N', 'R': 'R', 'Q': 'K', 'V': 'F', 'Z': 'S'}
+
+
+def metaphone(word):
+    """The Metaphone key of a word: how it sounds, in English spelling rules.
+
+    Words which sound alike, such as "Beyonce" and "Bionse", get the same or
+    very close keys. Characters other than A to Z are kept as they are.
+    """
+    word = word.upper()
+    if word[:2] in _INITIAL_EXCEPTIONS:
+        word = _INITIAL_EXCEPTIONS[word[:2]] + word[2:]
+    elif word[:1] == 'X':
+        word = 'S' + word[1:]
+    key = []
+    length = len(word)
+    for i, c in enumerate(word):
+        prev = word[i - 1] if i > 0 else ''
+        nxt = word[i + 1] if i + 1 < length else ''
+        after = word[i + 2] if i + 2 < length else ''
+        if c == prev and c != 'C':
+            continue
+        if c in _VOWELS:
+            if i == 0:
+                key.append(c)
+        elif c in _SAME:
+            key.append(_SAME[c])
+        elif c == 'B':
+            if not (prev == 'M' and i == length - 1):
+                key.append('B')
+        elif c == 'C':
+            if nxt == 'H' or (nxt == 'I' and after == 'A'):
+                key.append('K' if prev == 'S' else 'X')
+            elif nxt in _FRONT_VOWELS:
+                if prev != 'S':
+                    key.append('S')
+            else:
+                key.append('K')
+        elif c == 'D':
+            key.append('J' if nxt == 'G' and after in _FRONT_VOWELS else 'T')
+        elif c == 'G':
+            if nxt == 'H' and after and after not in _VOWELS:
+                continue
+            if nxt == 'N' and (i + 2 == length or word[i + 2:] == 'ED'):
+                continue
+            if prev == 'D' and nxt in _FRONT_VOWELS:
+                continue
+            key.append('J' if nxt in _FRONT_VOWELS and prev != 'G' else 'K')
+        elif c == 'H':
+            if prev in 'CSPTG' or (prev in _VOWELS and nxt not in _VOWELS):
+                continue
+            key.append('H')
+        elif c == 'K':
+            if prev != 'C':
+                key.append('K')
+        elif c == 'P':
+            key.append('F' if nxt == 'H' else 'P')
+        elif c == 'S':
+            key.append('X' if nxt == 'H' or (nxt == 'I' and after in 'OA') else 'S')
+        elif c == 'T':
+            if nxt == 'I' and after in 'OA':
+                key.append('X')
+            elif nxt == 'H':
+                key.append('0')
+            elif not (nxt == 'C' and after == 'H'):
+                key.append('T')
+        elif c in 'WY':
+            if nxt in _VOWELS:
+                key.append(c)
+        elif c == 'X':
+            key.append('KS')
+        else:
+            key.append(c)
+    return ''.join(key)
+
+
+def phonetic_key(name):
+    """The Metaphone keys of a name's words, in order and run together.
+
+    Running them together lets a name split into other words by speech
+    recognition ("beyond say") still sound like the original ("beyonce").
+    """
+    return ''.join(metaphone(word) for word in words(name))
+
+
+def ngrams(key, n=NGRAM):
+    padded = ' {} '.format(key)
+    return {padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))}
+
+
+class NameIndex:
+    """An n-gram blocked index of names, for fuzzy lookups.
+
+    Names are normalised once when added. Only the entries sharing the most
+    n-grams with a query are candidates, to be scored by the caller.
+    """
+
+    def __init__(self, names=()):
+        self._keys = []
+        self._values = []
+        self._grams = defaultdict(list)
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, name, value=None, key=None):
+        if key is None:
+            key = normalise(name)
+        entry = len(self._keys)
+        self._keys.append(key)
+        self._values.append(name if value is None else value)
+        for gram in ngrams(key):
+            self._grams[gram].append(entry)
+
+    def candidates(self, key, limit=MAX_CANDIDATES):
+        shared = Counter()
+        for gram in ngrams(key):
+            shared.update(self._grams.get(gram, ()))
+        return [entry for entry, _ in shared.most_common(limit)]
@@ -0,0 +1,179 @@
+# -*-: coding utf-8 -*-
+""" Latency histograms, Prometheus text export and per-request traces. """
+
+from __future__ import unicode_literals
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+# Per-request traces are logged here at DEBUG level, one JSON object per line.
+TRACE_LOG = logging.getLogger('snipsmopidy.trace')
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """Cumulative latency buckets for one metric, per label set."""
+
+    def __init__(self, name, help_text, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, seconds)] += 1
+            series[1] += seconds
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help_text),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+        for labels, (counts, total) in series:
+            pairs = ['{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                     for k, v in zip(self.label_names, labels)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    self.name, ','.join(pairs + ['le="{}"'.format(bound)]), cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, ','.join(pairs), total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, ','.join(pairs), cumulative))
+        return lines
+
+
+INTENT_SECONDS = Histogram(
+    'snipsmopidy_intent_seconds', "Time from receiving an intent to handling it.", ('handler', 'room'))
+MPD_SECONDS = Histogram(
+    'snipsmopidy_mpd_command_seconds', "Round trip time of MPD commands.", ('command', 'room'))
+SPOTIFY_SECONDS = Histogram(
+    'snipsmopidy_spotify_request_seconds', "Duration of Spotify Web API requests.", ('endpoint', 'status'))
+HISTOGRAMS = [INTENT_SECONDS, MPD_SECONDS, SPOTIFY_SECONDS]
+
+_trace = threading.local()
+
+
+def record(histogram, seconds, *labels):
+    """Observe a duration in ``histogram`` and in the current thread's trace."""
+    histogram.observe(seconds, *labels)
+    spans = getattr(_trace, 'spans', None)
+    if spans is not None:
+        spans.append({'metric': histogram.name, 'labels': labels, 'seconds': round(seconds, 6)})
+
+
+@contextmanager
+def timed(histogram, *labels):
+    """Time the enclosed block into ``histogram`` and the current trace."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(histogram, time.monotonic() - start, *labels)
+
+
+@contextmanager
+def traced(handler, room, start=None):
+    """Time a listener handler, logging a trace of everything it timed.
+
+    :param start: When the intent was received, if earlier than now
+    """
+    if start is None:
+        start = time.monotonic()
+    tracing = TRACE_LOG.isEnabledFor(logging.DEBUG)
+    if tracing:
+        _trace.spans = []
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        INTENT_SECONDS.observe(elapsed, handler, room)
+        if tracing:
+            spans, _trace.spans = _trace.spans, None
+            TRACE_LOG.debug(json.dumps({
+                'handler': handler,
+                'room': room,
+                'seconds': round(elapsed, 6),
+                'spans': spans,
+            }))
+
+
+class TimedClient:
+    """Proxy to an MPDClient which times every command it sends.
+
+    Commands queued in a command list are not sent until ``command_list_end``,
+    so the list is timed as one round trip, labelled with the commands in it,
+    such as ``command_list[add]``.
+    """
+
+    def __init__(self, client, room):
+        self.client = client
+        self.room = room
+        self._batch = set()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def timed_command(*args):
+            if name in ('command_list_begin', 'command_list_ok_begin'):
+                # Nothing is sent until the list ends.
+                self._batch = set()
+                return attr(*args)
+            if name == 'command_list_end':
+                label = 'command_list[{}]'.format(','.join(sorted(self._batch)))
+                self._batch = set()
+                with timed(MPD_SECONDS, label, self.room):
+                    return attr(*args)
+            if getattr(self.client, '_command_list', None) is not None:
+                self._batch.add(name)
+                return attr(*args)
+            with timed(MPD_SECONDS, name, self.room):
+                return attr(*args)
+        return timed_command
+
+
+def render():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(port, host=''):
+    """Serve the histograms at ``http://host:port/metrics`` from a daemon thread."""
+    # Imported here as http.server is slow to import and rarely needed.
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            LOG.debug(format, *args)
+
+    server = HTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,244 @@
+# -*-: coding utf-8 -*-
+""" Helpers for building Mopidy queues. """
+
+from __future__ import unicode_literals
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from itertools import islice
+import logging
+import threading
+
+from mpd import CommandError
+
+LOG = logging.getLogger(__name__)
+
+# Maximum number of commands sent to MPD in a single command list.
+COMMAND_LIST_SIZE = 500
+# Longest time a new intent waits for a cancelled queue fill to stop, in seconds.
+CANCEL_TIMEOUT = 3
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_command_list(client, commands):
+    """Send ``(command, *args)`` tuples to MPD as command lists.
+
+    A failing ``add`` does not abort the remaining commands. A failing
+    ``addid`` does, as the positions of the commands after it would be off.
+
+    :return: The URIs which could not be added to the queue
+    """
+    failed = []
+    pos = 0
+    while pos < len(commands):
+        chunk = commands[pos:pos + COMMAND_LIST_SIZE]
+        client.command_list_ok_begin()
+        for command in chunk:
+            getattr(client, command[0])(*command[1:])
+        try:
+            client.command_list_end()
+            pos += len(chunk)
+        except CommandError as e:
+            # MPD stops executing a command list at the first failing command,
+            # so skip over it and send the rest again.
+            if e.offset is None or chunk[e.offset][0] != 'add':
+                raise
+            LOG.warning("Song not available in catalogue: %s", chunk[e.offset][1])
+            failed.append(chunk[e.offset][1])
+            pos += e.offset + 1
+    return failed
+
+
+def _longest_increasing(values):
+    """The indices of a longest strictly increasing subsequence of ``values``."""
+    tails = []
+    tail_indices = []
+    previous = [None] * len(values)
+    for index, value in enumerate(values):
+        length = bisect_left(tails, value)
+        if length == len(tails):
+            tails.append(value)
+            tail_indices.append(index)
+        else:
+            tails[length] = value
+            tail_indices[length] = index
+        previous[index] = tail_indices[length - 1] if length else None
+    indices = []
+    index = tail_indices[-1] if tail_indices else None
+    while index is not None:
+        indices.append(index)
+        index = previous[index]
+    return indices[::-1]
+
+
+class _Positions:
+    """Which of ``size`` slots of a queue hold a song, as a Fenwick tree.
+
+    A song is placed, removed or located in O(log n) however long the queue.
+
+    :param filled: The slots holding a song to begin with
+    """
+
+    def __init__(self, size, filled):
+        self._tree = [0] * (size + 1)
+        for slot in filled:
+            self._tree[slot + 1] = 1
+        for index in range(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                self._tree[parent] += self._tree[index]
+        self.size = len(filled)
+
+    def _update(self, slot, delta):
+        index = slot + 1
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index += index & -index
+        self.size += delta
+
+    def add(self, slot):
+        self._update(slot, 1)
+
+    def remove(self, slot):
+        self._update(slot, -1)
+
+    def before(self, slot):
+        """The number of songs in the slots before ``slot``."""
+        index = slot
+        count = 0
+        while index:
+            count += self._tree[index]
+            index -= index & -index
+        return count
+
+
+def queue_diff(entries, uris, limit=None):
+    """The commands turning a queue into ``uris`` while keeping the songs already in it.
+
+    Songs of the queue which are not wanted are deleted, the wanted ones
+    missing are added, and of the songs kept only those outside their
+    longest run already in the wanted order are moved.
+
+    :param entries: The ``(id, uri)`` of each song in the queue, in order
+    :param limit: The most commands worth sending, as when replacing the queue takes fewer
+    :return: ``deleteid``, ``moveid`` and ``addid`` commands, none if the queue already holds ``uris``,
+        or None if more than ``limit`` are needed
+    """
+    available = defaultdict(deque)
+    for song_id, uri in entries:
+        available[uri].append(song_id)
+    # The song of the queue kept for each wanted URI, or None to add it.
+    wanted = [available[uri].popleft() if available.get(uri) else None for uri in uris]
+    kept_order = [song_id for song_id in wanted if song_id is not None]
+    # Each song not kept is deleted and each one missing added, whatever else is needed.
+    if limit is not None and len(entries) + len(uris) - 2 * len(kept_order) > limit:
+        return None
+    kept = set(kept_order)
+    commands = [('deleteid', song_id) for song_id, _ in entries if song_id not in kept]
+    positions = {song_id: pos for pos, song_id in enumerate(song_id for song_id, _ in entries if song_id in kept)}
+    stable = set(kept_order[index] for index in
+                 _longest_increasing([positions[song_id] for song_id in kept_order]))
+    if limit is not None and len(commands) + len(wanted) - len(stable) > limit:
+        return None
+    if len(stable) == len(wanted):
+        return commands
+    # Each other song goes right after the one before it, taken in order: the result is then ``uris``.
+    # So a song's slot in the queue follows the last stable song before it in
+    # ``uris``, in the run of songs placed after that one.
+    anchors = []
+    runs = [0] * (len(positions) + 1)
+    anchor, run = -1, 0
+    for song_id in wanted:
+        if song_id in stable:
+            anchor, run = positions[song_id], 0
+        else:
+            run += 1
+            runs[anchor + 1] = run
+        anchors.append((anchor, run))
+    starts = []
+    size = 0
+    for run in runs:
+        starts.append(size)
+        size += run + 1
+    slots = [starts[anchor + 1] + run for anchor, run in anchors]
+    # The songs kept start at their own slot, ahead of the run following them.
+    kept_slots = {song_id: starts[pos + 1] for song_id, pos in positions.items()}
+    queue = _Positions(size, list(kept_slots.values()))
+    for index, song_id in enumerate(wanted):
+        if song_id in stable:
+            continue
+        if song_id is not None:
+            queue.remove(kept_slots[song_id])
+        pos = queue.before(slots[index])
+        if song_id is None:
+            commands.append(('addid', uris[index], pos) if pos < queue.size else ('addid', uris[index]))
+        else:
+            commands.append(('moveid', song_id, pos))
+        queue.add(slots[index])
+    return commands
+
+
+def in_queue_order(entries, uris):
+    """``uris`` with those already queued first, in the order of the queue.
+
+    Used when the queue is shuffled anyway, so the songs already there need not move.
+    """
+    remaining = Counter(uris)
+    ordered = []
+    for _, uri in entries:
+        if remaining[uri] > 0:
+            remaining[uri] -= 1
+            ordered.append(uri)
+    for uri in uris:
+        if remaining[uri] > 0:
+            remaining[uri] -= 1
+            ordered.append(uri)
+    return ordered
+
+
+class QueueFiller(threading.Thread):
+    """Appends URIs to a room's queue in the background.
+
+    Each chunk is sent on a connection taken from the room's pool, so the
+    worker never holds a connection that an intent handler is waiting for.
+
+    :param connections: The MopidyConnectionManager to take connections from
+    :param site_id: The room whose queue is filled
+    :param uris: An iterable of URIs, consumed lazily
+    :param shuffle: Whether to shuffle everything after the current song once filled
+    """
+
+    def __init__(self, connections, site_id, uris, shuffle=False):
+        super().__init__(name="queue-fill-{}".format(site_id), daemon=True)
+        self.connections = connections
+        self.site_id = site_id
+        self.uris = uris
+        self.shuffle = shuffle
+        self.failed = []
+        self._cancelled = threading.Event()
+
+    def cancel(self, timeout=CANCEL_TIMEOUT):
+        self._cancelled.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+
+    def run(self):
+        try:
+            for chunk in chunks(self.uris, COMMAND_LIST_SIZE):
+                if self._cancelled.is_set():
+                    return
+                with self.connections.connection(self.site_id) as client:
+                    self.failed.extend(run_command_list(client, [('add', uri) for uri in chunk]))
+            if self.shuffle and not self._cancelled.is_set():
+                with self.connections.connection(self.site_id) as client:
+                    current = int(client.status().get('song', 0))
+                    client.shuffle('{}:'.format(current + 1))
+        except Exception:
+            LOG.exception("Filling the queue for %s failed", self.site_id)
@@ -0,0 +1,106 @@
+# -*-: coding utf-8 -*-
+""" Rate limiting and coalescing of Spotify Web API requests. """
+
+from __future__ import unicode_literals
+from concurrent.futures import Future
+import threading
+import time
+
+# Spotify does not publish its limit, which is over a rolling 30 seconds; stay well below it.
+SPOTIFY_RATE = 10
+SPOTIFY_BURST = 20
+# Longest a request is held back, by the rate limit or a Retry-After, before it fails as throttled.
+MAX_WAIT = 5
+# Statuses Spotify answers with a Retry-After when it throttles requests.
+THROTTLED_STATUSES = (429, 503)
+# Retry-After assumed when a throttled response has none, in seconds.
+DEFAULT_RETRY_AFTER = 1
+
+
+class SpotifyThrottled(Exception):
+    """Spotify is throttling requests, as opposed to having found nothing.
+
+    :param retry_after: Seconds to wait before trying again
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("Spotify is throttling requests, retry in {:.0f}s".format(retry_after))
+        self.retry_after = retry_after
+
+
+def retry_after(response):
+    """The seconds a throttled response asks to wait."""
+    try:
+        return max(float(response.headers.get('Retry-After', DEFAULT_RETRY_AFTER)), 0)
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+class TokenBucket:
+    """Spaces out requests to ``rate`` per second, allowing bursts of ``burst``.
+
+    Tokens are reserved ahead, so the bucket goes negative while requests
+    wait their turn in arrival order. A Retry-After empties it for that long,
+    which holds back every request sharing the bucket.
+    """
+
+    def __init__(self, rate=SPOTIFY_RATE, burst=SPOTIFY_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, max_wait=MAX_WAIT):
+        """Wait for a token.
+
+        :raises SpotifyThrottled: If the token would take more than ``max_wait`` seconds
+        """
+        with self._lock:
+            self._refill()
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            if wait > max_wait:
+                raise SpotifyThrottled(wait)
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold every request back for ``seconds`` from now."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class SingleFlight:
+    """Shares the result of a call among the callers asking for the same key meanwhile."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """``fn()``, or the result of the call already running for ``key``."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
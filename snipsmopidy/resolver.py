@@ -0,0 +1,169 @@
+# -*-: coding utf-8 -*-
+""" Local resolution of spoken names to playlists, artists, albums and titles. """
+
+from __future__ import unicode_literals
+from collections import namedtuple
+import re
+import threading
+
+from .index import NameIndex, normalise, phonetic_key, words
+
+# A name scoring above this is taken as the one asked for.
+FUZZ_RATIO = 87
+# Shortest Metaphone key trusted to tell names apart: shorter ones, such as
+# those of "back" and "Beck" or "stink" and "Sting", are alike too often.
+PHONETIC_MIN_LENGTH = 5
+
+Match = namedtuple('Match', 'kind name value score source')
+
+_DIGITS = re.compile(r'\d+')
+
+
+def numbers(name):
+    """The numbers in a name, which tell apart names that are otherwise alike.
+
+    Numbers are read from spelled-out words and from within words too, so
+    "you two" has the number of "U2".
+    """
+    return tuple(_DIGITS.findall(' '.join(words(name))))
+
+
+class _Entries:
+    """The names of one kind from one source, blocked on text and on sound."""
+
+    def __init__(self):
+        self.names = []
+        self.values = []
+        self._added = set()
+        self.keys = []
+        # The first entry of each key, for exact lookups.
+        self.exact = {}
+        self.numbers = []
+        self.compact = []
+        self.phonetic = []
+        self.text_index = NameIndex()
+        self.phonetic_index = NameIndex()
+
+    def add(self, name, value):
+        try:
+            if (name, value) in self._added:
+                return
+            self._added.add((name, value))
+        except TypeError:
+            pass
+        key = normalise(name)
+        sound = phonetic_key(name)
+        entry = len(self.names)
+        self.names.append(name)
+        self.values.append(value)
+        self.keys.append(key)
+        self.exact.setdefault(key, entry)
+        self.numbers.append(numbers(name))
+        self.compact.append(''.join(words(name)))
+        self.phonetic.append(sound)
+        self.text_index.add(name, entry, key=key)
+        if sound:
+            self.phonetic_index.add(name, entry, key=sound)
+
+    def candidates(self, key, sound):
+        entries = set(self.text_index.candidates(key))
+        if sound:
+            entries.update(self.phonetic_index.candidates(sound))
+        return entries
+
+
+class EntityResolver:
+    """One index of every name a user may ask for, from any source.
+
+    Names are added per source (a room's MPD library or stored playlists,
+    the user's Spotify playlists, past Spotify searches...) and kind
+    (``playlist``, ``artist``, ``album``, ``title``...). A query is matched
+    both on its normalised text and on its Metaphone key, so names which
+    speech recognition spelled differently or split into other words still
+    resolve, without asking Mopidy or Spotify.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def update(self, source, kind, names):
+        """Replace the names of a kind from a source.
+
+        :param names: Names, or ``(name, value)`` tuples; a name's value defaults to the name
+        """
+        entries = _Entries()
+        for item in names:
+            name, value = item if isinstance(item, tuple) else (item, item)
+            if name:
+                entries.add(name, value)
+        with self._lock:
+            self._entries[(source, kind)] = entries
+
+    def add(self, source, kind, name, value=None):
+        if not name:
+            return
+        with self._lock:
+            entries = self._entries.get((source, kind))
+            if entries is None:
+                entries = self._entries[(source, kind)] = _Entries()
+            entries.add(name, name if value is None else value)
+
+    def __len__(self):
+        return sum(len(entries.names) for entries in self._entries.values())
+
+    def _select(self, kinds, sources):
+        with self._lock:
+            return [
+                (source, kind, entries) for (source, kind), entries in self._entries.items()
+                if (kinds is None or kind in kinds) and (sources is None or source in sources)
+            ]
+
+    def resolve(self, query, kinds=None, sources=None, limit=1, min_score=0):
+        """Rank the names best matching a query.
+
+        Every candidate sharing n-grams with the query's text or sound is
+        scored on both. The score is the text similarity, raised towards
+        the sound similarity when the two sound more alike than they are
+        spelled and both are long enough for their sound to tell them apart;
+        only an exact spelling scores 100.
+
+        :param kinds: Only match names of these kinds
+        :param sources: Only match names from these sources
+        :return: Up to ``limit`` Matches scoring above min_score, best first
+        """
+        # Imported on first use to keep it off the startup path.
+        from fuzzywuzzy import fuzz
+
+        key = normalise(query)
+        compact = ''.join(words(query))
+        sound = phonetic_key(query)
+        query_numbers = numbers(query)
+        matches = []
+        for source, kind, entries in self._select(kinds, sources):
+            for entry in entries.candidates(key, sound):
+                # "Volume 1" is never "Volume 2", however alike they look.
+                if entries.numbers[entry] != query_numbers:
+                    continue
+                # Also compare without spaces, for names split or joined differently.
+                score = max(fuzz.ratio(key, entries.keys[entry]), fuzz.ratio(compact, entries.compact[entry]))
+                if min(len(sound), len(entries.phonetic[entry])) >= PHONETIC_MIN_LENGTH and score < 100:
+                    score = max(score, (score + 2 * fuzz.ratio(sound, entries.phonetic[entry])) // 3)
+                if score > min_score:
+                    matches.append(Match(kind, entries.names[entry], entries.values[entry], score, source))
+        matches.sort(key=lambda match: match.score, reverse=True)
+        return matches[:limit]
+
+    def best(self, query, kind, sources=None, min_score=FUZZ_RATIO):
+        """The Match of a kind best matching a query, or None if none scores above min_score."""
+        matches = self.resolve(query, (kind,), sources, 1, min_score)
+        return matches[0] if matches else None
+
+    def exact(self, query, kind, sources=None):
+        """The Match of a kind spelled as the query once normalised, or None."""
+        key = normalise(query)
+        for source, _, entries in self._select((kind,), sources):
+            entry = entries.exact.get(key)
+            if entry is not None:
+                return Match(kind, entries.names[entry], entries.values[entry], 100, source)
+        return None
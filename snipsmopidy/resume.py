@@ -0,0 +1,92 @@
+# -*-: coding utf-8 -*-
+""" Per-room snapshots of replaced queues, to go back to what was playing. """
+
+from __future__ import unicode_literals
+from collections import defaultdict, namedtuple
+import sqlite3
+import threading
+import time
+
+# Number of snapshots kept per room.
+MAX_SNAPSHOTS = 5
+
+QueueSnapshot = namedtuple('QueueSnapshot', 'uris position elapsed saved_at')
+
+
+def queue_uris(client):
+    """The URIs of a room's queue, in order.
+
+    ``playlist`` is much lighter than ``playlistinfo`` on a long queue, but
+    python-mpd2 returns its entries as ``file: <uri>``.
+    """
+    return [entry[len('file: '):] if entry.startswith('file: ') else entry for entry in client.playlist()]
+
+
+class ResumeStore:
+    """The most recent queue snapshots of each room, newest last.
+
+    Each room keeps at most ``max_snapshots``. When ``path`` is given the
+    snapshots are also kept in a sqlite database, so they survive restarts.
+    URIs are stored newline separated, which is much smaller than the song
+    dicts MPD returns.
+
+    :param path: The sqlite file to persist snapshots to, or None to keep them in memory only
+    """
+
+    def __init__(self, path=None, max_snapshots=MAX_SNAPSHOTS):
+        self.max_snapshots = max_snapshots
+        self._snapshots = defaultdict(list)
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS resume_snapshots ("
+                " room TEXT, saved_at REAL, position INTEGER, elapsed REAL, uris TEXT)")
+            self._load()
+
+    def _load(self):
+        rows = self._db.execute(
+            "SELECT room, uris, position, elapsed, saved_at FROM resume_snapshots ORDER BY saved_at")
+        for room, uris, position, elapsed, saved_at in rows.fetchall():
+            self._snapshots[room].append(QueueSnapshot(uris.split('\n'), position, elapsed, saved_at))
+        for room in list(self._snapshots):
+            self._trim(room)
+
+    def save(self, room, uris, position, elapsed):
+        """Keep a snapshot of a room's queue, dropping its oldest beyond max_snapshots."""
+        if not uris:
+            return
+        snapshot = QueueSnapshot(list(uris), position or 0, elapsed or 0.0, time.time())
+        with self._lock:
+            self._snapshots[room].append(snapshot)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        "INSERT INTO resume_snapshots VALUES (?, ?, ?, ?, ?)",
+                        (room, snapshot.saved_at, snapshot.position, snapshot.elapsed, '\n'.join(snapshot.uris)))
+            self._trim(room)
+
+    def _trim(self, room):
+        snapshots = self._snapshots[room]
+        while len(snapshots) > self.max_snapshots:
+            self._remove(room, snapshots.pop(0))
+
+    def pop(self, room):
+        """Take the newest snapshot of a room, or None if there is none."""
+        with self._lock:
+            snapshots = self._snapshots.get(room)
+            if not snapshots:
+                return None
+            snapshot = snapshots.pop()
+            self._remove(room, snapshot)
+            return snapshot
+
+    def _remove(self, room, snapshot):
+        if self._db is not None:
+            with self._db:
+                self._db.execute(
+                    "DELETE FROM resume_snapshots WHERE room = ? AND saved_at = ?", (room, snapshot.saved_at))
+
+    def __len__(self):
+        return sum(len(snapshots) for snapshots in self._snapshots.values())
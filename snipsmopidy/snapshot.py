@@ -0,0 +1,181 @@
+# -*-: coding utf-8 -*-
+""" Memory-mapped snapshot of a Spotify user's favourites, to find them without a search. """
+
+from __future__ import unicode_literals
+from collections import namedtuple
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .index import normalise
+
+MAGIC = b'SMFS'
+VERSION = 2
+_HEADER = struct.Struct('<4sHI')
+# Offset and length in the file of an entry's key, then of its fields.
+_RECORD = struct.Struct('<IIII')
+# Separates the kind, normalised name and source of a key.
+KEY_SEP = '\x00'
+# Separates the fields of an entry.
+FIELD_SEP = '\t'
+
+# ``source`` is the id of the playlist an entry was found in, or '' for the user's top and saved items.
+SnapshotEntry = namedtuple('SnapshotEntry', 'kind name id href snapshot_id source')
+
+
+def entry_of(kind, item, source=''):
+    """The SnapshotEntry of a Spotify API item, or None if it lacks a name or id."""
+    if not item or not item.get('name') or not item.get('id'):
+        return None
+    return SnapshotEntry(
+        kind, item['name'].replace(FIELD_SEP, ' '), item['id'],
+        item.get('tracks', {}).get('href') or '', item.get('snapshot_id') or '', source)
+
+
+def item_of(entry):
+    """The fields of a SnapshotEntry as a Spotify API item."""
+    item = {'id': entry.id, 'name': entry.name, 'uri': 'spotify:{}:{}'.format(entry.kind, entry.id)}
+    if entry.href:
+        item['tracks'] = {'href': entry.href}
+    if entry.snapshot_id:
+        item['snapshot_id'] = entry.snapshot_id
+    return item
+
+
+def _key(kind, name, source=''):
+    return KEY_SEP.join((kind, normalise(name), source)).encode('utf-8')
+
+
+def write_snapshot(path, entries):
+    """Write entries to a snapshot file, replacing it atomically.
+
+    Entries are sorted on their kind, normalised name and source; only the
+    first entry of each is kept. Readers of the old file keep their mapping.
+    """
+    records = {}
+    for entry in entries:
+        if normalise(entry.name):
+            records.setdefault(_key(entry.kind, entry.name, entry.source), entry)
+    keys = sorted(records)
+    index = bytearray()
+    table = bytearray()
+    base = _HEADER.size + len(keys) * _RECORD.size
+    for key in keys:
+        entry = records[key]
+        fields = FIELD_SEP.join(entry[1:]).encode('utf-8')
+        key_offset = base + len(table)
+        table += key
+        index += _RECORD.pack(key_offset, len(key), key_offset + len(key), len(fields))
+        table += fields
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as outfile:
+        outfile.write(_HEADER.pack(MAGIC, VERSION, len(keys)))
+        outfile.write(index)
+        outfile.write(table)
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+class SnapshotWriter:
+    """Collects the entries of a snapshot from several threads."""
+
+    def __init__(self):
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def add(self, kind, items, source=''):
+        entries = [entry for entry in (entry_of(kind, item, source) for item in items) if entry is not None]
+        with self._lock:
+            self.entries.extend(entries)
+
+    def add_entries(self, entries):
+        with self._lock:
+            self.entries.extend(entries)
+
+    def write(self, path):
+        with self._lock:
+            return write_snapshot(path, self.entries)
+
+
+class FavouritesSnapshot:
+    """Lookup of the user's favourites by kind and name in a snapshot file.
+
+    The file is memory-mapped, so opening it costs next to nothing whatever
+    its size, and a lookup is a binary search over its sorted keys. Names
+    are compared in their normalised form, as in the EntityResolver. A
+    missing or unreadable file gives an empty snapshot.
+
+    :param path: The snapshot file, as written by write_snapshot
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mapped = (None, 0)
+        self.reload()
+
+    def reload(self):
+        """Map the file again, after it was rewritten."""
+        try:
+            with open(self.path, 'rb') as infile:
+                data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # A missing or empty file.
+            self._mapped = (None, 0)
+            return
+        magic, version, count = _HEADER.unpack_from(data) if len(data) >= _HEADER.size else (None, None, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mapped = (None, 0)
+            return
+        # The previous mapping is closed once the readers still using it are done.
+        self._mapped = (data, count)
+
+    def age(self):
+        """Seconds since the file was written, or None if there is none."""
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def __len__(self):
+        return self._mapped[1]
+
+    @staticmethod
+    def _record(data, position):
+        return _RECORD.unpack_from(data, _HEADER.size + position * _RECORD.size)
+
+    def _entry(self, data, position):
+        key_offset, key_length, offset, length = self._record(data, position)
+        kind = data[key_offset:key_offset + key_length].split(b'\x00', 1)[0].decode('utf-8')
+        return SnapshotEntry(kind, *data[offset:offset + length].decode('utf-8').split(FIELD_SEP))
+
+    def get(self, kind, name):
+        """The item of a kind named ``name``, or None.
+
+        Top and saved items come before the same name found in a playlist.
+        """
+        data, count = self._mapped
+        if not count:
+            return None
+        prefix = _key(kind, name)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, _, _ = self._record(data, middle)
+            if data[key_offset:key_offset + key_length] < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        if low == count:
+            return None
+        key_offset, key_length, _, _ = self._record(data, low)
+        if not data[key_offset:key_offset + key_length].startswith(prefix):
+            return None
+        return item_of(self._entry(data, low))
+
+    def entries(self):
+        """Every SnapshotEntry, in key order."""
+        data, count = self._mapped
+        for position in range(count):
+            yield self._entry(data, position)
@@ -1,115 +1,236 @@
 import argparse
+from functools import wraps
 import json
 import logging
 import logging.config
+import math
 
 from snipslistener import SnipsListener, hotword_detected, intent, session_ended
 
+from .connection import MopidyUnavailable
+from .dispatch import RoomDispatcher, per_room
+from .metrics import start_metrics_server
+from .ratelimit import SpotifyThrottled
 from .snipsmopidy import SnipsMopidy
 
 LOG = logging.getLogger(__name__)
 
 
+class UnknownRoom(Exception):
+    """Raised when an intent names a room which is neither a configured room nor a group.
+
+    :param room: The room named
+    """
+
+    def __init__(self, room):
+        super().__init__("Unknown room {}".format(room))
+        self.room = room
+
+
+def reports_throttling(fn):
+    """End the session telling the user to retry when Spotify throttles the handler, rather than failing silently."""
+    @wraps(fn)
+    def wrapper(self, data):
+        try:
+            return fn(self, data)
+        except SpotifyThrottled as e:
+            LOG.warning("%s: %s", fn.__name__, e)
+            data.session_manager.end_session(
+                "Spotify is busy, please try again in {} seconds.".format(max(math.ceil(e.retry_after), 1)))
+    return wrapper
+
+
+def reports_unavailable(fn):
+    """End the session telling the user when the room asked for is unknown or its Mopidy cannot be reached."""
+    @wraps(fn)
+    def wrapper(self, data):
+        try:
+            return fn(self, data)
+        except UnknownRoom as e:
+            LOG.warning("%s: %s", fn.__name__, e)
+            data.session_manager.end_session("There is no room called {}.".format(e.room))
+        except MopidyUnavailable as e:
+            LOG.warning("%s: %s", fn.__name__, e)
+            data.session_manager.end_session("Mopidy is not available in {}.".format(e.room))
+    return wrapper
+
+
 class SnipsMopidyListener(SnipsListener):
 
-    def __init__(self, mqtt_host, mqtt_port=1883, mopidy_rooms={'default': {'host': '127.0.0.1', 'port': 6600}}):
+    def __init__(self, mqtt_host, mqtt_port=1883, mopidy_rooms={'default': {'host': '127.0.0.1', 'port': 6600}},
+                 async_rooms=False, metrics_port=None, lazy_connect=False, resume_path=None,
+                 autoplay=True, library_catalogue=False):
         super().__init__(mqtt_host, mqtt_port)
-        self.skill = SnipsMopidy(mopidy_rooms)
+        self.skill = SnipsMopidy(mopidy_rooms, lazy_connect=lazy_connect, resume_path=resume_path,
+                                 autoplay=autoplay, library_catalogue=library_catalogue)
+        # With async_rooms, handlers run on a per-room queue instead of the MQTT callback thread.
+        self.dispatcher = RoomDispatcher() if async_rooms else None
+        self.metrics_server = start_metrics_server(metrics_port) if metrics_port is not None else None
+
+    def target_room(self, data):
+        """The room or group named in the intent, or the room it was spoken in.
+
+        :raises UnknownRoom: If the room named is neither a configured room nor a group
+        """
+        if 'room_name' in data.slots:
+            room = data.slots['room_name'].value
+            if room not in self.skill.connections.pools and self.skill.group_members(room) is None:
+                raise UnknownRoom(room)
+            return room
+        return data.site_id
+
+    def dispatch_room(self, data):
+        """The room whose commands a handler is ordered with: the group named, or the room serving the target."""
+        # Hotword and session messages have no slots and act on the room they come from.
+        try:
+            room = self.target_room(data) if getattr(data, 'slots', None) else data.site_id
+        except UnknownRoom:
+            # The handler only tells the user, in the room it was spoken in.
+            room = data.site_id
+        if self.skill.group_members(room) is not None:
+            return room
+        return self.skill.connections.room(room)
 
     @hotword_detected
+    @per_room
     def set_to_low_volume(self, data):
+        self.skill.prefetch(data.site_id)
         self.skill.set_to_low_volume(data.site_id)
 
     @session_ended
+    @per_room
     def restore_volume(self, data):
         self.skill.set_to_previous_volume(data.site_id)
 
     @intent('speakerInterrupt')
+    @per_room
+    @reports_unavailable
     def pause(self, data):
-        self.skill.pause(data.site_id)
+        self.skill.pause(self.target_room(data))
         data.session_manager.end_session()
 
     @intent('volumeUp')
+    @per_room
+    @reports_unavailable
     def volume_up(self, data):
         self.skill.set_to_previous_volume(data.site_id)
+        room = self.target_room(data)
         if 'volume_higher' in data.slots:
             volume_higher = data.slots['volume_higher'].value
             LOG.debug("volume_higher={}".format(volume_higher))
-            self.skill.volume_up(data.site_id, volume_higher)
+            self.skill.volume_up(room, volume_higher)
         else:
-            self.skill.volume_up(data.site_id, None)
+            self.skill.volume_up(room, None)
         data.session_manager.end_session()
 
     @intent('volumeDown')
+    @per_room
+    @reports_unavailable
     def volume_down(self, data):
         self.skill.set_to_previous_volume(data.site_id)
+        room = self.target_room(data)
         if 'volume_lower' in data.slots:
             volume_lower = data.slots['volume_lower'].value
             LOG.debug("volume_lower={}".format(volume_lower))
-            self.skill.volume_down(data.site_id, volume_lower)
+            self.skill.volume_down(room, volume_lower)
         else:
-            self.skill.volume_down(data.site_id, None)
+            self.skill.volume_down(room, None)
         data.session_manager.end_session()
 
     @intent('playPlaylist')
+    @per_room
+    @reports_unavailable
+    @reports_throttling
     def play_playlist(self, data):
         playlist_name = data.slots['playlist_name'].value
         shuffle = ('playlist_lecture_mode' in data.slots
                    and data.slots['playlist_lecture_mode'] == 'shuffle')
-        self.skill.play_playlist(data.site_id, playlist_name, shuffle=shuffle)
+        self.skill.play_playlist(self.target_room(data), playlist_name, shuffle=shuffle)
         data.session_manager.end_session()
 
     @intent('playArtist')
+    @per_room
+    @reports_unavailable
+    @reports_throttling
     def play_artist(self, data):
         artist_name = data.slots['artist_name'].value
-        self.skill.play_artist(data.site_id, artist_name)
+        self.skill.play_artist(self.target_room(data), artist_name)
         data.session_manager.end_session()
 
     @intent('playSong')
+    @per_room
+    @reports_unavailable
+    @reports_throttling
     def play_song(self, data):
-        self.skill.play_song(data.site_id, data.slots['song_name'])
+        self.skill.play_song(self.target_room(data), data.slots['song_name'])
         data.session_manager.end_session()
 
     @intent('playAlbum')
+    @per_room
+    @reports_unavailable
+    @reports_throttling
     def play_album(self, data):
         album_name = data.slots['album_name'].value
         shuffle = ('album_lecture_mode' in data.slots
                    and data.slots['album_lecture_mode'] == 'shuffle')
-        self.skill.play_album(data.site_id, album_name, shuffle=shuffle)
+        self.skill.play_album(self.target_room(data), album_name, shuffle=shuffle)
         data.session_manager.end_session()
 
     @intent('resumeMusic')
+    @per_room
+    @reports_unavailable
     def resume(self, data):
-        self.skill.play(data.site_id)
+        self.skill.play(self.target_room(data))
         data.session_manager.end_session()
 
+    @intent('resumePreviousMusic')
+    @per_room
+    @reports_unavailable
+    def resume_previous(self, data):
+        if self.skill.resume_previous(self.target_room(data)):
+            data.session_manager.end_session()
+        else:
+            data.session_manager.end_session("There is nothing to go back to.")
+
     @intent('nextSong')
+    @per_room
+    @reports_unavailable
+    @reports_throttling
     def next_song(self, data):
-        success = self.skill.play_next_item_in_queue(data.site_id)
+        success = self.skill.play_next_item_in_queue(self.target_room(data))
         if success:
             data.session_manager.end_session()
         else:
             data.session_manager.end_session("There is no next song.")
 
     @intent('previousSong')
+    @per_room
+    @reports_unavailable
     def prev_song(self, data):
-        success = self.skill.play_previous_item_in_queue(data.site_id)
+        success = self.skill.play_previous_item_in_queue(self.target_room(data))
         if success:
             data.session_manager.end_session()
         else:
             data.session_manager.end_session("There is no previous song.")
 
     @intent('addSong')
+    @per_room
+    @reports_unavailable
+    @reports_throttling
     def add_song(self, data):
         self.skill.add_song(data.site_id)
         data.session_manager.end_session()
 
     @intent('getInfos')
+    @per_room
+    @reports_unavailable
     def get_info(self, data):
         self.skill.set_to_previous_volume(data.site_id)
-        data.session_manager.end_session(
-            "This is {} by {} on the album {}".format(*self.skill.get_info(data.site_id))
-        )
+        info = self.skill.get_info(data.site_id)
+        if info is None:
+            data.session_manager.end_session("Nothing is playing.")
+        else:
+            data.session_manager.end_session("This is {} by {} on the album {}".format(*info))
 
 
 def main():
@@ -126,6 +247,18 @@ def main():
         if 'mopidy_rooms' in config:
             assert isinstance(config['mopidy_rooms'], dict)
             listener_args['mopidy_rooms'] = config['mopidy_rooms']
+        if 'async_rooms' in config:
+            listener_args['async_rooms'] = bool(config['async_rooms'])
+        if 'lazy_connect' in config:
+            listener_args['lazy_connect'] = bool(config['lazy_connect'])
+        if 'resume_path' in config:
+            listener_args['resume_path'] = config['resume_path']
+        if 'autoplay' in config:
+            listener_args['autoplay'] = bool(config['autoplay'])
+        if 'library_catalogue' in config:
+            listener_args['library_catalogue'] = bool(config['library_catalogue'])
+        if 'metrics_port' in config:
+            listener_args['metrics_port'] = int(config['metrics_port'])
         if 'logging_config' in config:
             logging.config.dictConfig(config['logging_config'])
         listener = SnipsMopidyListener(**listener_args)
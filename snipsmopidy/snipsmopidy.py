@@ -2,38 +2,62 @@
 """ Mopidy skill for Snips. """
 
 from __future__ import unicode_literals
+from concurrent.futures import ThreadPoolExecutor, wait
 from functools import wraps
-import threading
-import time
-import traceback
+from itertools import chain, islice
+import logging
+import random
 
-from fuzzywuzzy import fuzz
-from mpd import MPDClient
-from mpd import ConnectionError
+from mpd import CommandError, ConnectionError
 
-from .spotify import SpotifyClient
+from .autoplay import RoomAutoplay, remaining
+from .catalogue import LibraryCatalogue
+from .connection import MopidyConnectionManager
+from .playqueue import COMMAND_LIST_SIZE, QueueFiller, in_queue_order, queue_diff, run_command_list
+from .resolver import FUZZ_RATIO, EntityResolver
+from .resume import ResumeStore
+from .state import RoomQueue, RoomState
+from .volume import RoomVolume
+
+LOG = logging.getLogger(__name__)
 
-MAX_VOLUME = 100
 GAIN = 4
 MPD_PORT = 6600
-FUZZ_RATIO = 80
 LOW_VOLUME = 10
+# Name of the group containing every room.
+ALL_ROOMS = 'everywhere'
+# Longest time a command sent to a group of rooms waits for all of them, in seconds.
+FAN_OUT_TIMEOUT = 10
+# A streamed queue is synced instead when its first songs, up to this many, are all queued already.
+SYNC_PROBE_SIZE = 10
 
 
 def capwords(in_str):
     return ' '.join(s[:1].upper() + s[1:] for s in in_str.split())
 
 
+def grouped(fn):
+    """Run the command in every member room when called with a group name."""
+    @wraps(fn)
+    def wrapper(self, site_id, *args, **kwargs):
+        members = self.group_members(site_id)
+        if members is None:
+            return fn(self, site_id, *args, **kwargs)
+        return self.fan_out(members, fn, *args, **kwargs)
+    return wrapper
+
+
 def room_based(fn):
+    @grouped
     @wraps(fn)
     def wrapper(self, site_id, *args, **kwargs):
         try:
-            client = self.get_client(site_id)
-            client.ping()
-            return fn(self, site_id, client, *args, **kwargs)
+            with self.connections.connection(site_id) as client:
+                return fn(self, site_id, client, *args, **kwargs)
         except ConnectionError:
-            self.connect_one_mopidy(site_id, self.mopidy_rooms[site_id])
-            return fn(self, site_id, self.get_client(site_id), *args, **kwargs)
+            # The pooled connection died since its last health check, retry once on a fresh one.
+            with self.connections.connection(site_id) as client:
+                return fn(self, site_id, client, *args, **kwargs)
     return wrapper
 
 
@@ -43,188 +67,425 @@ class SnipsMopidy:
     :param mopidy_host: The hostname of the Mopidy player
     """
 
-    def __init__(self, mopidy_rooms={'default': {'host': '127.0.0.1', 'port': 6600}}, locale=None):
+    def __init__(self, mopidy_rooms={'default': {'host': '127.0.0.1', 'port': 6600}}, locale=None,
+                 stream_queue=True, library_catalogue=False, lazy_connect=False, resume_path=None,
+                 autoplay=True):
         self.mopidy_rooms = mopidy_rooms
-        self.mopidy_instances = {}
-        self.prev_volume = {}
-
-        connect_threads = [
-            threading.Thread(target=self.connect_one_mopidy, args=(k, v))
-            for k, v in mopidy_rooms.items()
-        ]
-        for t in connect_threads:
-            t.start()
-        for t in connect_threads:
-            t.join()
+        # Rooms connect in the background (or on first use with lazy_connect), never blocking startup.
+        self.connections = MopidyConnectionManager(mopidy_rooms, lazy=lazy_connect)
+        self.groups = {
+            name: details['rooms'] for name, details in mopidy_rooms.items() if 'rooms' in details
+        }
+        self.groups.setdefault(ALL_ROOMS, list(self.connections.pools))
+        self.fan_out_executor = ThreadPoolExecutor(
+            max_workers=max(len(self.connections.pools), 1), thread_name_prefix="fan-out")
+        self.players = {}
+        self.queues = {}
+        self.volumes = {}
+        self.stream_queue = stream_queue
+        # The QueueFiller still appending to each room's queue, by room.
+        self.queue_fillers = {}
+        # Names of every room's playlists and library, and of the Spotify favourites, for local lookups.
+        self.resolver = EntityResolver()
+        self.indexed_playlists = set()
+        self.library_catalogue = library_catalogue
+        self.catalogues = {}
+        # Queues replaced by an intent, so resume_previous can go back to them.
+        self.resume_store = ResumeStore(resume_path)
+        # With autoplay, related tracks are appended before a room's queue runs out.
+        self.autoplay = autoplay
+        self.autoplays = {}
 
         self.spotify = None
         # if spotify_refresh_token is not None:
-        #     self.spotify = SpotifyClient(spotify_refresh_token, spotify_client_id, spotify_client_secret)
-
-    def connect_one_mopidy(self, site_id, details):
-        while True:
-            client = MPDClient()
-            try:
-                client.connect(details['host'], details.get('port', 6600))
-                self.mopidy_instances[site_id] = client
-                break
-            except Exception:
-                traceback.print_exc()
-                print("Mopidy is not yet available on {}, retrying".format(details['host']))
-                print("...")
-                time.sleep(5)
-
-    def get_client(self, site_id):
-        if site_id in self.mopidy_instances:
-            return self.mopidy_instances[site_id]
-        else:
-            return self.mopidy_instances['default']
+        #     from .spotify import SpotifyClient
+        #     self.spotify = SpotifyClient(spotify_refresh_token, spotify_client_id, spotify_client_secret,
+        #                                  resolver=self.resolver)
 
     @room_based
     def pause(self, site_id, client):
         client.pause(1)
 
-    @room_based
-    def volume_up(self, site_id, client, level):
+    def group_members(self, site_id):
+        """The rooms of a group, or None if ``site_id`` is not a group."""
+        if site_id in self.connections.pools:
+            return None
+        return self.groups.get(site_id)
+
+    def fan_out(self, rooms, fn, *args, **kwargs):
+        """Call ``fn(self, room, ...)`` concurrently for every room.
+
+        A room which fails or misses FAN_OUT_TIMEOUT does not hold up the others.
+
+        :return: A dict of room to result, or to the exception raised
+        """
+        futures = {
+            self.fan_out_executor.submit(fn, self, room, *args, **kwargs): room for room in rooms
+        }
+        done, not_done = wait(futures, timeout=FAN_OUT_TIMEOUT)
+        results = {}
+        for future in done:
+            room = futures[future]
+            try:
+                results[room] = future.result()
+            except Exception as e:
+                LOG.warning("Command %s failed in %s: %s", fn.__name__, room, e)
+                results[room] = e
+        for future in not_done:
+            room = futures[future]
+            LOG.warning("Command %s timed out in %s", fn.__name__, room)
+            results[room] = TimeoutError("{} timed out in {}".format(fn.__name__, room))
+        return results
+
+    def prefetch(self, site_id):
+        """Get a room ready for the intent expected to follow a hotword.
+
+        Nothing here blocks: the room's connections are checked and the Spotify
+        token and connection warmed in the background.
+        """
+        self.connections.get_pool(site_id).warm()
+        if self.spotify is not None:
+            self.spotify.prefetch()
+
+    def get_player(self, site_id):
+        """The RoomState of the room serving ``site_id``, created on first use.
+
+        Other components can follow a room's player with its ``subscribe``.
+        """
+        room = self.connections.room(site_id)
+        if room not in self.players:
+            self.players[room] = RoomState(self.connections, room)
+        return self.players[room]
+
+    def get_queue(self, site_id):
+        """The RoomQueue of the room serving ``site_id``, created on first use."""
+        room = self.connections.room(site_id)
+        if room not in self.queues:
+            self.queues[room] = RoomQueue(self.connections, room)
+        return self.queues[room]
+
+    def get_volume(self, site_id):
+        """The RoomVolume of the room serving ``site_id``, created on first use."""
+        room = self.connections.room(site_id)
+        if room not in self.volumes:
+            self.volumes[room] = RoomVolume(self.connections, self.get_player(room))
+        return self.volumes[room]
+
+    def get_autoplay(self, site_id):
+        """The RoomAutoplay of the room serving ``site_id``, created on first use, or None without autoplay."""
+        if not self.autoplay:
+            return None
+        room = self.connections.room(site_id)
+        if room not in self.autoplays:
+            self.autoplays[room] = RoomAutoplay(
+                self.connections, self.get_player(room), lambda song, client: self.related_uris(room, song, client))
+        return self.autoplays[room]
+
+    def related_uris(self, room, song, client):
+        """URIs of tracks related to a song: its artist's top tracks, or the artist's library tracks.
+
+        None while a QueueFiller is still appending the source of the room's queue.
+
+        :param client: A connection to the room, for the library search
+        """
+        filler = self.queue_fillers.get(room)
+        if filler is not None and filler.is_alive():
+            return None
+        artist = song.get('artist')
+        if isinstance(artist, list):
+            artist = artist[0]
+        if not artist:
+            return []
+        if self.spotify is not None:
+            tracks = self.spotify.get_top_tracks_from_artist(artist) or []
+            return [track['uri'] for track in tracks]
+        songs = client.find('artist', artist)
+        random.shuffle(songs)
+        return [song['file'] for song in songs]
+
+    @grouped
+    def volume_up(self, site_id, level):
         level = int(level)*10 if level is not None else 10
-        status = client.status()
-        current_volume = int(status.get('volume'))
-        new_volume = min(current_volume - GAIN * level, MAX_VOLUME)
-        client.setvol(new_volume)
+        self.get_volume(site_id).adjust(GAIN * level)
 
-    @room_based
-    def volume_down(self, site_id, client, level):
+    @grouped
+    def volume_down(self, site_id, level):
         level = int(level)*10 if level is not None else 10
-        status = client.status()
-        current_volume = int(status.get('volume'))
-        new_volume = max(current_volume - GAIN * level, 0)
-        client.setvol(new_volume)
+        self.get_volume(site_id).adjust(-GAIN * level)
 
-    @room_based
-    def set_volume(self, site_id, client, volume_value):
-        client.setvol(volume_value)
+    @grouped
+    def set_volume(self, site_id, volume_value):
+        self.get_volume(site_id).set(volume_value)
 
-    @room_based
-    def set_to_low_volume(self, site_id, client):
-        status = client.status()
-        if status.get('state') != 'play':
-            return None
-        current_volume = int(status.get('volume'))
-        self.prev_volume[site_id] = current_volume
-        client.setvol(min(LOW_VOLUME, current_volume))
+    @grouped
+    def set_to_low_volume(self, site_id):
+        self.get_volume(site_id).duck(LOW_VOLUME)
 
-    @room_based
-    def set_to_previous_volume(self, site_id, client):
-        if site_id not in self.prev_volume:
-            return None
-        client.setvol(self.prev_volume[site_id])
-        del self.prev_volume[site_id]
+    @grouped
+    def set_to_previous_volume(self, site_id):
+        self.get_volume(site_id).restore()
 
     @room_based
     def stop(self, site_id, client):
+        self.cancel_queue_fill(site_id)
         client.stop()
 
+    def replace_queue(self, client, uris, shuffle=False):
+        """Replace the queue with the given URIs and start playing.
+
+        The whole sequence is sent as MPD command lists, so a queue of any
+        length costs a handful of round trips instead of one per track.
+
+        :return: The URIs which could not be added to the queue
+        """
+        commands = [('stop',), ('clear',)]
+        commands.extend(('add', uri) for uri in uris)
+        if shuffle:
+            commands.append(('shuffle',))
+        commands.append(('play',))
+        return run_command_list(client, commands)
+
+    def sync_queue(self, site_id, client, uris, shuffle=False, load=None):
+        """Make the queue of a room hold the given URIs and start playing it.
+
+        Unlike replace_queue, the songs already queued are kept: only those
+        which differ are deleted, added or moved, so asking again for what
+        is queued costs a single short command list. The queue is replaced
+        as a whole when that takes fewer commands.
+
+        :param load: Commands filling an empty queue with the URIs, such as loading the stored
+            playlist holding them, used instead of adding them when the queue is replaced
+        :return: The URIs which could not be added to the queue
+        """
+        entries = self.get_queue(site_id).refresh(client)
+        if shuffle:
+            # The queue is shuffled afterwards, so the songs already queued can stay where they are.
+            uris = in_queue_order(entries, uris)
+        commands = queue_diff(entries, uris, limit=len(uris) + 1)
+        if commands is None:
+            if load is None:
+                return self.replace_queue(client, uris, shuffle)
+            commands = [('stop',), ('clear',)] + load
+        if shuffle:
+            commands.append(('shuffle',))
+        commands.append(('play', 0))
+        try:
+            return run_command_list(client, commands)
+        except CommandError:
+            # An unavailable song would shift the positions after it; build the queue again.
+            return self.replace_queue(client, uris, shuffle)
+
+    def save_queue(self, site_id, client):
+        """Snapshot a room's queue, song and position before the queue is replaced."""
+        player = self.get_player(site_id).get(client)
+        if not player.queue_length:
+            return
+        position = int(player.song.get('pos', 0)) if player.song else 0
+        uris = [uri for _, uri in self.get_queue(site_id).refresh(client)]
+        self.resume_store.save(self.connections.room(site_id), uris, position, player.position())
+
     @room_based
-    def play_playlist(self, site_id, client, name, shuffle=False):
-        if self.spotify is not None:
-            return self.play_spotify_playlist(client, name, shuffle)
-        mpd_pls = client.listplaylists()
-        for pls in mpd_pls:
-            if fuzz.token_sort_ratio(pls['playlist'], name) > FUZZ_RATIO:
-                client.clear()
-                client.load(pls['playlist'])
-                if shuffle:
-                    client.shuffle()
+    def resume_previous(self, site_id, client):
+        """Go back to the last queue replaced in a room, at the song and position it was at.
+
+        The queue is rebuilt from its snapshot in one batch of command lists,
+        without searching for it again, then played from the song it was at.
+
+        :return: False if there is no queue to go back to
+        """
+        snapshot = self.resume_store.pop(self.connections.room(site_id))
+        if snapshot is None:
+            return False
+        self.cancel_queue_fill(site_id)
+        commands = [('stop',), ('clear',)]
+        commands.extend(('add', uri) for uri in snapshot.uris)
+        missing = set(run_command_list(client, commands))
+        uris = [uri for uri in snapshot.uris if uri not in missing]
+        if not uris:
+            return False
+        # Songs before the current one which are gone now shift its position.
+        position = snapshot.position - sum(1 for uri in snapshot.uris[:snapshot.position] if uri in missing)
+        play = [('play', min(position, len(uris) - 1))]
+        current = snapshot.uris[snapshot.position] if snapshot.position < len(snapshot.uris) else None
+        if snapshot.elapsed and current is not None and current not in missing:
+            play.append(('seekcur', snapshot.elapsed))
+        run_command_list(client, play)
+        return True
+
+    def cancel_queue_fill(self, site_id):
+        filler = self.queue_fillers.pop(self.connections.room(site_id), None)
+        if filler is not None:
+            filler.cancel()
+
+    def play_uris(self, site_id, client, uris, shuffle=False):
+        """Replace the queue of a room with the given URIs and start playing.
+
+        In streaming mode playback starts as soon as the first track is queued
+        and the rest are appended by a QueueFiller, which is cancelled when a
+        newer intent replaces the queue of the same room. When the queue
+        already holds the first songs asked for, it is synced instead, so
+        asking again for what is queued only sends what differs.
+        """
+        self.cancel_queue_fill(site_id)
+        self.save_queue(site_id, client)
+        if not self.stream_queue:
+            failed = self.sync_queue(site_id, client, list(uris), shuffle)
+            self.get_autoplay(site_id)
+            return failed
+
+        uris = iter(uris)
+        head = list(islice(uris, SYNC_PROBE_SIZE))
+        queued = set(self.get_queue(site_id).uris(client))
+        if head and queued.issuperset(head):
+            # Most likely the same songs asked for again: fetch them all and only change what differs.
+            failed = self.sync_queue(site_id, client, head + list(uris), shuffle)
+            self.get_autoplay(site_id)
+            return failed
+        if shuffle:
+            head.extend(islice(uris, COMMAND_LIST_SIZE - len(head)))
+            random.shuffle(head)
+        uris = chain(head, uris)
+        run_command_list(client, [('stop',), ('clear',)])
+        failed = []
+        for uri in uris:
+            if not run_command_list(client, [('add', uri)]):
                 client.play()
                 break
+            failed.append(uri)
         else:
+            return failed
+
+        filler = QueueFiller(self.connections, site_id, uris, shuffle)
+        filler.failed = failed
+        self.queue_fillers[self.connections.room(site_id)] = filler
+        filler.start()
+        self.get_autoplay(site_id)
+        return failed
+
+    @room_based
+    def play_playlist(self, site_id, client, name, shuffle=False):
+        if self.spotify is not None:
+            return self.play_spotify_playlist(site_id, client, name, shuffle)
+        self.cancel_queue_fill(site_id)
+        self.index_playlists(site_id, client)
+        room = self.connections.room(site_id)
+        match = self.resolver.best(name, 'playlist', sources=(room,), min_score=FUZZ_RATIO)
+        if match is None:
             # TODO TTS playlist not found
-            pass
+            return None
+        self.save_queue(site_id, client)
+        if self.get_queue(site_id).get(client):
+            self.sync_queue(site_id, client, client.listplaylist(match.value), shuffle, [('load', match.value)])
+        else:
+            client.clear()
+            client.load(match.value)
+            if shuffle:
+                client.shuffle()
+            client.play()
+        self.get_autoplay(site_id)
+
+    def index_playlists(self, site_id, client):
+        """Index a room's stored playlists in the resolver, with the room as their source.
+
+        They are indexed on first use and again whenever MPD reports a change
+        to the stored playlists.
+        """
+        room = self.connections.room(site_id)
+        if room not in self.indexed_playlists:
+            self.resolver.update(room, 'playlist', (pls['playlist'] for pls in client.listplaylists()))
+            self.indexed_playlists.add(room)
+            self.connections.subscribe(
+                room, lambda subsystem: self.refresh_playlist_index(room), 'stored_playlist')
+
+    def refresh_playlist_index(self, room):
+        with self.connections.connection(room) as client:
+            self.resolver.update(room, 'playlist', (pls['playlist'] for pls in client.listplaylists()))
 
     def play_spotify_playlist(self, site_id, client, name, shuffle=False):
         tracks = self.spotify.get_playlist(name)
         if tracks is None:
             return None
-        client.stop()
-        client.clear()
-        for track in tracks:
-            try:
-                client.add(track['track']['uri'])
-            except Exception:
-                print("Song not available in catalogue")
-        if shuffle:
-            client.shuffle()
-        client.play()
+        # Tracks which are no longer available have no track object.
+        uris = (track['track']['uri'] for track in tracks if track.get('track'))
+        self.play_uris(site_id, client, uris, shuffle)
 
     @room_based
     def play_artist(self, site_id, client, name):
         if self.spotify is not None:
-            return self.play_spotify_artist(client, name)
-        self.play_by_tag(client, 'artist', name)
+            return self.play_spotify_artist(site_id, client, name)
+        self.play_by_tag(site_id, client, 'artist', name)
 
-    def play_by_tag(self, client, tag, name):
-        if len(client.find(tag, capwords(name))) > 0:
-            client.stop()
-            client.clear()
-            client.findadd(tag, capwords(name))
-        elif len(client.search(tag, name)) > 0:
-            client.stop()
-            client.clear()
-            client.searchadd(tag, name)
-        else:
+    def get_catalogue(self, site_id):
+        if not self.library_catalogue:
+            return None
+        room = self.connections.room(site_id)
+        if room not in self.catalogues:
+            self.catalogues[room] = LibraryCatalogue(self.connections, room, resolver=self.resolver)
+        return self.catalogues[room]
+
+    def play_by_tag(self, site_id, client, tag, name):
+        self.cancel_queue_fill(site_id)
+        catalogue = self.get_catalogue(site_id)
+        if catalogue is not None and catalogue.ready.is_set():
+            # Resolve the exact tag value locally, so one findadd is enough.
+            value = catalogue.resolve(tag, name)
+            if value is None:
+                return False
+            self.save_queue(site_id, client)
+            run_command_list(client, [('stop',), ('clear',), ('findadd', tag, value), ('play',)])
+            self.get_autoplay(site_id)
+            return True
+        songs = client.find(tag, capwords(name)) or client.search(tag, name)
+        if not songs:
             return False
-        client.play()
+        self.save_queue(site_id, client)
+        self.sync_queue(site_id, client, [song['file'] for song in songs])
+        self.get_autoplay(site_id)
         return True
 
-    def play_spotify_artist(self, client, name):
+    def play_spotify_artist(self, site_id, client, name):
         tracks = self.spotify.get_top_tracks_from_artist(name)
         if tracks is None:
             return None
-        client.stop()
-        client.clear()
-        for track in tracks:
-            client.add(track['uri'])
-        client.play()
+        self.play_uris(site_id, client, (track['uri'] for track in tracks))
 
     @room_based
     def play_album(self, site_id, client, album, shuffle=False):
         if self.spotify is not None:
-            return self.play_spotify_album(client, album, shuffle)
-        self.play_by_tag(client, 'album', album)
+            return self.play_spotify_album(site_id, client, album, shuffle)
+        self.play_by_tag(site_id, client, 'album', album)
 
-    def play_spotify_album(self, client, album, shuffle):
+    def play_spotify_album(self, site_id, client, album, shuffle):
         tracks = self.spotify.get_tracks_from_album(album)
         if tracks is None:
             return None
-        client.stop()
-        client.clear()
-        for track in tracks:
-            client.add(track['uri'])
-        if shuffle:
-            client.shuffle()
-        client.play()
+        self.play_uris(site_id, client, (track['uri'] for track in tracks), shuffle)
 
     @room_based
     def play_song(self, site_id, client, name):
         if self.spotify is not None:
-            return self.play_spotify_song(client, name)
-        self.play_by_tag(client, 'title', name)
+            return self.play_spotify_song(site_id, client, name)
+        self.play_by_tag(site_id, client, 'title', name)
 
-    def play_spotify_song(self, client, name):
+    def play_spotify_song(self, site_id, client, name):
         track = self.spotify.get_track(name)
         if track is None:
             return None
-        client.stop()
-        client.clear()
-        client.add(track['uri'])
-        client.play()
+        self.play_uris(site_id, client, [track['uri']])
 
     @room_based
     def play_next_item_in_queue(self, site_id, client):
+        """Skip to the next song, appending related tracks first if the queue has run out."""
+        snapshot = self.get_player(site_id).get(client)
+        autoplay = self.get_autoplay(site_id)
+        if autoplay is not None and remaining(snapshot) == 0 and not snapshot.repeat:
+            # Autoplay normally keeps songs ahead; this only happens when it had no time to.
+            if not autoplay.extend(snapshot.song, client):
+                return False
         try:
             client.next()
             return True
-        except Exception:
+        except CommandError:
             return False
 
     @room_based
@@ -232,20 +493,22 @@ class SnipsMopidy:
         try:
             client.previous()
             return True
-        except Exception:
+        except CommandError:
             return False
 
-    @room_based
-    def get_info(self, site_id, client):
-        # Get info about currently playing tune
-        info = client.currentsong()
-        return info['title'], info['artist'], info['album']
+    def get_info(self, site_id):
+        """Title, artist and album of the current song, or None if there is none."""
+        info = self.get_player(site_id).get().song
+        if info is None:
+            return None
+        return info.get('title'), info.get('artist'), info.get('album')
 
-    @room_based
-    def add_song(self, site_id, client):
+    def add_song(self, site_id):
         # TODO: Save song in spotify
-        info = client.currentsong()
-        self.spotify.add_song(info['artist'], info['title'])
+        info = self.get_player(site_id).get().song
+        if info is None:
+            return
+        self.spotify.add_song(info.get('artist'), info.get('title'))
 
     @room_based
     def play(self, site_id, client):
@@ -1,39 +1,219 @@
 # -*-: coding utf-8 -*-
 """ Mopidy skill for Snips. """
 
-import codecs
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import logging
+import re
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
 
+from .metrics import SPOTIFY_SECONDS, record
+from .ratelimit import MAX_WAIT, THROTTLED_STATUSES, SingleFlight, SpotifyThrottled, TokenBucket, retry_after
+from .resolver import FUZZ_RATIO, EntityResolver
+from .snapshot import FavouritesSnapshot
+from .spotify_cache import SearchCache, cache_key
+
+LOG = logging.getLogger(__name__)
+
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+# Refresh the access token this many seconds before Spotify expires it.
+TOKEN_EXPIRY_MARGIN = 60
+# A prefetch refreshes the access token if it expires within this many seconds.
+PREFETCH_EXPIRY_MARGIN = 300
+API_URL = "https://api.spotify.com/"
+HTTP_POOL_SIZE = 4
+HTTP_TIMEOUT = 10
+# Times a throttled request is retried after its Retry-After, if that is within MAX_WAIT.
+THROTTLE_RETRIES = 1
+# Number of pages of a paged endpoint fetched concurrently.
+PAGE_WORKERS = 4
+# The user's playlists are refreshed in the background when older than this, in seconds.
+PLAYLIST_REFRESH_INTERVAL = 600
+# The favourites snapshot is rebuilt in the background when older than this, in seconds.
+SNAPSHOT_REFRESH_INTERVAL = 6 * 3600
+# Resolver sources of the user's playlists and of past search results.
+USER_PLAYLISTS = 'spotify:playlists'
+SEARCHES = 'spotify:searches'
+
+_SPOTIFY_ID = re.compile(r'/[0-9A-Za-z]{22}(?=/|$)')
+
+
+def endpoint_label(url):
+    """The URL path with Spotify ids replaced, for use as a metric label."""
+    path = url.split('?', 1)[0].split('//', 1)[-1]
+    return _SPOTIFY_ID.sub('/{id}', path[path.find('/'):])
 
-class SpotifyClient():
 
-    def __init__(self, spotify_refresh_token, client_id, client_secret):
+class SpotifySession():
+    """Keep-alive HTTP session for the Spotify Web API.
+
+    The access token is cached until shortly before it expires, and refreshed
+    once more if Spotify still answers 401.
+
+    Every request waits for a token of one TokenBucket, and a throttled
+    response pauses the bucket for its Retry-After. Identical GETs in flight
+    at the same time, such as the same search from several rooms, share one
+    HTTP request.
+    """
+
+    def __init__(self, spotify_refresh_token, client_id, client_secret, api_url=API_URL, token_url=TOKEN_URL):
+        self.api_url = api_url
+        self.token_url = token_url
         self.client_id = client_id
         self.client_secret = client_secret
         self.refresh_token = spotify_refresh_token
-        self.get_user_playlists()
-        self.get_user_id()
+        self.access_token = None
+        self.expires_at = 0
+        self._token_lock = threading.Lock()
+        self.bucket = TokenBucket()
+        self.in_flight = SingleFlight()
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
 
-    def refresh_access_token(self):
-        _r = requests.post(
-            "https://accounts.spotify.com/api/token",
+    def _refresh(self):
+        _r = self._send(
+            'POST',
+            self.token_url,
             data={
                 "client_id": self.client_id,
                 "client_secret": self.client_secret,
                 "grant_type": "refresh_token",
                 "refresh_token": self.refresh_token
-            })
-        if 'access_token' in _r.json():
-            self.access_token = _r.json()['access_token']
+            },
+            timeout=HTTP_TIMEOUT)
+        token = _r.json()
+        if 'access_token' in token:
+            self.access_token = token['access_token']
+            self.expires_at = time.monotonic() + token.get('expires_in', 3600) - TOKEN_EXPIRY_MARGIN
         else:
             self.access_token = None
+            self.expires_at = 0
+        return self.access_token
+
+    def refresh_access_token(self):
+        with self._token_lock:
+            return self._refresh()
+
+    def get_access_token(self):
+        with self._token_lock:
+            if self.access_token is None or time.monotonic() >= self.expires_at:
+                return self._refresh()
+            return self.access_token
+
+    def _send(self, method, url, **kwargs):
+        start = time.monotonic()
+        status = 'error'
+        try:
+            _r = self.http.request(method, url, **kwargs)
+            status = _r.status_code
+            return _r
+        finally:
+            record(SPOTIFY_SECONDS, time.monotonic() - start, endpoint_label(url), status)
+
+    def prefetch(self):
+        """Make sure the next request needs neither a token refresh nor a new connection."""
+        with self._token_lock:
+            if self.access_token is None or time.monotonic() >= self.expires_at - PREFETCH_EXPIRY_MARGIN:
+                self._refresh()
+        # Any response leaves a kept-alive connection to the API host in the pool.
+        self.http.head(self.api_url, timeout=HTTP_TIMEOUT)
+
+    def request(self, method, url, **kwargs):
+        """Send a request once the rate limit allows it.
+
+        :raises SpotifyThrottled: If Spotify still throttles it after THROTTLE_RETRIES, or
+            would have it wait longer than MAX_WAIT
+        """
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        headers = kwargs.pop('headers', {})
+        for _ in range(THROTTLE_RETRIES + 1):
+            self.bucket.acquire(MAX_WAIT)
+            headers["Authorization"] = "Bearer {}".format(self.get_access_token())
+            _r = self._send(method, url, headers=headers, **kwargs)
+            if _r.status_code == 401:
+                headers["Authorization"] = "Bearer {}".format(self.refresh_access_token())
+                _r = self._send(method, url, headers=headers, **kwargs)
+            if _r.status_code not in THROTTLED_STATUSES:
+                return _r
+            wait = retry_after(_r)
+            self.bucket.pause(wait)
+        raise SpotifyThrottled(wait)
+
+    def api(self, path):
+        """The URL of a Web API path such as ``v1/search``."""
+        return self.api_url + path
+
+    def get(self, url, **kwargs):
+        """GET a URL, sharing the response with identical GETs already in flight."""
+        key = (url, tuple(sorted((kwargs.get('params') or {}).items())))
+        return self.in_flight.do(key, lambda: self._get(url, **kwargs))
+
+    def _get(self, url, **kwargs):
+        _r = self.request('GET', url, **kwargs)
+        # Read the body now, as the response may be shared between threads.
+        _r.content
+        return _r
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+
+class PlaylistRecord():
+    """The fields of a user playlist needed to find and play it."""
+
+    __slots__ = ('id', 'name', 'tracks_href', 'snapshot_id')
+
+    def __init__(self, playlist):
+        self.id = playlist['id']
+        self.name = playlist['name']
+        self.tracks_href = playlist['tracks']['href']
+        self.snapshot_id = playlist.get('snapshot_id')
+
+
+class SpotifyClient():
+    """Spotify Web API client of the skill.
+
+    The user's playlists and the names of past search results are indexed in
+    an EntityResolver, so a name close enough to one of them, even as
+    misheard by speech recognition, needs no search request.
+
+    The user's top and saved tracks, their artists and albums, and their
+    playlists with the tracks in them can also be found by name in a
+    FavouritesSnapshot, rebuilt in the background when older than
+    SNAPSHOT_REFRESH_INTERVAL; a search is then only needed for the rest.
+
+    :param search_cache: The SearchCache of search results, or None for an in-memory one
+    :param resolver: The EntityResolver to index names in, or None for one of its own
+    :param snapshot_path: The FavouritesSnapshot file, or None not to keep one
+    """
+
+    def __init__(self, spotify_refresh_token, client_id, client_secret, search_cache=None,
+                 api_url=API_URL, token_url=TOKEN_URL, resolver=None, snapshot_path=None):
+        self.session = SpotifySession(spotify_refresh_token, client_id, client_secret, api_url, token_url)
+        self.search_cache = search_cache if search_cache is not None else SearchCache()
+        self.resolver = resolver if resolver is not None else EntityResolver()
+        self.snapshot = FavouritesSnapshot(snapshot_path) if snapshot_path is not None else None
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
+        self._background = ThreadPoolExecutor(1, thread_name_prefix="spotify-revalidate")
+        self.user_id = None
+        self.user_playlists = {}
+        self.playlists_refreshed_at = None
+        self._playlists_lock = threading.Lock()
+        self._playlists_refreshing = False
+        self.refresh_user_playlists_async()
+
+    def refresh_access_token(self):
+        self.session.refresh_access_token()
 
     def get_user_id(self):
-        _r = requests.get(
-            "https://api.spotify.com/v1/me",
-            headers={
-                "Authorization": "Bearer {}".format(self.access_token),
-            })
+        _r = self.session.get(self.session.api("v1/me"))
 
         if 'id' in _r.json():
             self.user_id = _r.json()['id']
@@ -41,198 +221,283 @@ class SpotifyClient():
             self.user_id = None
 
     def get_user_playlists(self):
-        # TODO: get all playlists if there are more than 50 by looping
-        # and using the offset parameters
-        self.refresh_access_token()
-        self.user_playlists = {}
-        n_found_playlists = 0
-        while True:
-            _r = requests.get(
-                "https://api.spotify.com/v1/me/playlists",
-                params={
-                    'limit': 50,
-                    'offset': n_found_playlists,
-                },
-                headers={
-                    "Authorization": "Bearer {}".format(self.access_token),
-                })
-            if 'items' in _r.json():
-                items = _r.json()['items']
-            else:
-                items = []
-            self.user_playlists.update({
-                playlist['name'].lower(): playlist for
-                playlist in items})
-            if len(self.user_playlists) == n_found_playlists:
-                break
-            n_found_playlists = len(self.user_playlists)
+        """Refresh the index of the user's playlists.
+
+        Playlists whose snapshot_id has not changed keep their existing record.
+        """
+        pages = self.get_pages(self.session.api("v1/me/playlists"), 50)
+        if pages is None:
+            return
+        playlists = {}
+        for page in pages:
+            for playlist in page:
+                record = self.user_playlists.get(playlist['id'])
+                if record is None or record.snapshot_id != playlist.get('snapshot_id'):
+                    record = PlaylistRecord(playlist)
+                playlists[record.id] = record
+        self.resolver.update(USER_PLAYLISTS, 'playlist', [(record.name, record) for record in playlists.values()])
+        with self._playlists_lock:
+            self.user_playlists = playlists
+            self.playlists_refreshed_at = time.monotonic()
+
+    def refresh_user_playlists_async(self):
+        with self._playlists_lock:
+            if self._playlists_refreshing:
+                return
+            self._playlists_refreshing = True
+
+        def refresh():
+            try:
+                self.index_searches()
+                if self.user_id is None:
+                    self.get_user_id()
+                self.get_user_playlists()
+                if self.snapshot is not None:
+                    age = self.snapshot.age()
+                    # An empty snapshot may also be one written by an older version.
+                    if age is None or age > SNAPSHOT_REFRESH_INTERVAL or not len(self.snapshot):
+                        self.rebuild_snapshot()
+            except Exception:
+                LOG.exception("Could not refresh the user playlists")
+            finally:
+                with self._playlists_lock:
+                    self._playlists_refreshing = False
+        threading.Thread(target=refresh, name="spotify-playlists", daemon=True).start()
+
+    def find_user_playlist(self, playlist_name):
+        """The PlaylistRecord best matching a name, or None.
+
+        The index is refreshed in the background once it is older than PLAYLIST_REFRESH_INTERVAL.
+        """
+        refreshed_at = self.playlists_refreshed_at
+        if refreshed_at is not None and time.monotonic() - refreshed_at > PLAYLIST_REFRESH_INTERVAL:
+            self.refresh_user_playlists_async()
+        match = self.resolver.best(playlist_name, 'playlist', (USER_PLAYLISTS,), FUZZ_RATIO)
+        return match.value if match is not None else None
+
+    def index_searches(self):
+        """Index the names of the cached search results, by the query they are cached under.
+
+        Results found since are added as they come, and this rebuilds the
+        index with the playlists, dropping results evicted from the cache.
+        """
+        by_type = {}
+        for search_type, query, item in self.search_cache.entries():
+            by_type.setdefault(search_type, []).append((item.get('name'), query))
+        for search_type, names in by_type.items():
+            self.resolver.update(SEARCHES, search_type, names)
+
+    def rebuild_snapshot(self):
+        """Export the user's favourites to the snapshot again, and map the new one.
+
+        The tracks of playlists unchanged since the current snapshot are not fetched again.
+        """
+        from .export import FavouritesExporter
+
+        # The snapshot serves these names already; seeding the cache would evict the user's searches.
+        FavouritesExporter(self).export(snapshot=self.snapshot.path, previous=self.snapshot, seed_cache=False)
+        self.snapshot.reload()
+
+    def favourite(self, kind, name):
+        """The user's favourite of a kind with that name, from the snapshot, or None."""
+        if self.snapshot is None:
+            return None
+        return self.snapshot.get(kind, name)
 
     def dump_favorite(self, mode, n_items, output_name):
         if mode not in ['artists', 'tracks']:
             raise ValueError("mode argument should be 'artists' or 'tracks")
-        self.refresh_access_token()
-        all_items = set()
-        for time_range in ['long_term', 'medium_term', 'short_term']:
-            current_items = []
-            n_found_items = 0
-            while n_found_items <= n_items:
-                _r = requests.get(
-                    'https://api.spotify.com/v1/me/top/{}'.format(mode),
-                    params={
-                        'limit': min(50, n_items - n_found_items),
-                        # 50 is the maximum
-                        'offset': n_found_items,
-                        'time_range': time_range
-                    },
-                    headers={
-                        "Authorization": "Bearer {}".format(self.access_token),
-                    }
-                )
-                current_items.extend(
-                    [item['name'] for item in _r.json()['items']])
-                if len(current_items) == n_found_items:
-                    break
-                n_found_items = len(current_items)
-            all_items.update(current_items)
-        with codecs.open(output_name, 'w', 'utf-8') as f:
-            f.write(u"\n".join(all_items))
+        from .export import FavouritesExporter
+
+        FavouritesExporter(self).export(
+            **{mode: output_name, 'saved_tracks': False, 'playlist_tracks': False, 'top_limit': n_items})
 
     def dump_playlists(self, output_name):
-        with codecs.open(output_name, 'w', 'utf-8') as f:
-            f.write(u"\n".join(self.user_playlists.keys()))
+        from .export import FavouritesExporter
 
-    def get_top_tracks_from_artist(self, artist):
-        self.refresh_access_token()
-        # First get artist id
+        FavouritesExporter(self).export(playlists=output_name, top=False, saved_tracks=False, playlist_tracks=False)
+
+    def prefetch(self):
+        """Warm the token and the API connection on a background thread."""
+        def prefetch():
+            try:
+                self.session.prefetch()
+            except Exception:
+                LOG.exception("Could not prefetch from Spotify")
+        self._background.submit(prefetch)
+
+    def search(self, query, search_type):
+        """The best match of a search, or None.
+
+        Cached results are served without a request; stale ones are then
+        refreshed in the background for the next time. A query which is not
+        cached but is spelled as the name of a cached result uses that result.
+
+        :raises SpotifyThrottled: If a search was needed and Spotify throttles it
+        """
+        cached = self.search_cache.get(search_type, query)
+        if cached is None:
+            # Only the same name: a name merely alike may well be another artist.
+            match = self.resolver.exact(query, search_type, sources=(SEARCHES,))
+            if match is not None:
+                query = match.value
+                cached = self.search_cache.get(search_type, query)
+        if cached is None:
+            return self._search(query, search_type)
+        item, fresh = cached
+        if not fresh:
+            self._revalidate(query, search_type)
+        return item
+
+    def _search(self, query, search_type):
         try:
-            _r = requests.get(
-                'https://api.spotify.com/v1/search',
+            _r = self.session.get(
+                self.session.api('v1/search'),
                 params={
-                    'q': artist,
-                    'type': 'artist'
-                },
-                headers={
-                    "Authorization": "Bearer {}".format(self.access_token)
+                    'q': query,
+                    'type': search_type
                 }
             )
-            _id = _r.json()['artists']['items'][0]['id']
+            # return best match
+            item = _r.json()['{}s'.format(search_type)]['items'][0]
+        except (requests.RequestException, ValueError, KeyError, IndexError):
+            return None
+        self.search_cache.put(search_type, query, item)
+        self.resolver.add(SEARCHES, search_type, item.get('name'), query)
+        return item
+
+    def _revalidate(self, query, search_type):
+        key = cache_key(search_type, query)
+        with self._revalidating_lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def revalidate():
+            try:
+                self._search(query, search_type)
+            finally:
+                with self._revalidating_lock:
+                    self._revalidating.discard(key)
+        self._background.submit(revalidate)
+
+    def get_top_tracks_from_artist(self, artist):
+        # First get artist id
+        artist = self.favourite('artist', artist) or self.search(artist, 'artist')
+        if artist is None:
+            return None
+        try:
             # Get list of top tracks from artist
-            _r = requests.get(
-                'https://api.spotify.com/v1/artists/{}/top-tracks'.format(_id),
+            _r = self.session.get(
+                self.session.api('v1/artists/{}/top-tracks'.format(artist['id'])),
                 params={
                     'country': 'fr'
-                },
-                headers={
-                    "Authorization": "Bearer {}".format(self.access_token)
                 }
             )
             return _r.json()['tracks']
-        except Exception:
+        except (requests.RequestException, ValueError, KeyError):
             return None
 
     def get_tracks_href_from_playlist(self, playlist_name):
+        record = self.find_user_playlist(playlist_name)
+        if record is not None:
+            return record.tracks_href
+        playlist = self.favourite('playlist', playlist_name)
+        if playlist is not None and 'tracks' in playlist:
+            return playlist['tracks']['href']
+        print("Unknown user playlist, trying to find a similar playlist")
+        # Get any playlist related to the name given
+        playlist = self.search(playlist_name, 'playlist')
+        if playlist is None:
+            return None
+        return playlist['tracks']['href']
+
+    def get_page(self, url, limit, offset, params=None):
+        """One page of a paged endpoint, or None if it could not be fetched.
+
+        :raises SpotifyThrottled: If Spotify throttles the request
+        """
+        params = dict(params or {}, limit=limit, offset=offset)
         try:
-            return self.user_playlists[playlist_name.lower()]['tracks']['href']
-        except KeyError:
-            print("Unknown user playlist, trying to find a similar playlist")
-            # Get any playlist related to the name given
-            self.refresh_access_token()
-            try:
-                _r = requests.get(
-                    'https://api.spotify.com/v1/search',
-                    params={
-                        'q': playlist_name,
-                        'type': 'playlist'
-                    },
-                    headers={
-                        "Authorization": "Bearer {}".format(self.access_token)
-                    }
-                )
-                # return best match
-                tracks_href = _r.json()['playlists']['items'][0]['tracks']['href']
-                return tracks_href
-            except Exception:
-                return None
+            page = self.session.get(url, params=params).json()
+        except (requests.RequestException, ValueError):
+            return None
+        return page if 'items' in page else None
+
+    def get_pages(self, url, limit, params=None):
+        """Fetch every page of a paged endpoint.
+
+        The first page is fetched right away; once it gives the total, the
+        other pages are fetched concurrently by up to PAGE_WORKERS threads.
+
+        :param params: Query parameters sent with every page besides limit and offset
+        :return: A generator of each page's items in order, or None if the first page failed
+        """
+        first = self.get_page(url, limit, 0, params)
+        if first is None:
+            return None
+        return self._iter_pages(url, limit, first, params)
+
+    def _iter_pages(self, url, limit, first, params=None):
+        yield first['items']
+        offsets = range(limit, first.get('total', 0), limit)
+        if not offsets:
+            return
+        pool = ThreadPoolExecutor(min(PAGE_WORKERS, len(offsets)))
+        try:
+            futures = [pool.submit(self.get_page, url, limit, offset, params) for offset in offsets]
+            for future in futures:
+                try:
+                    page = future.result()
+                except SpotifyThrottled:
+                    page = None
+                if page is None:
+                    LOG.warning("Could not fetch all the tracks from %s", url)
+                    return
+                yield page['items']
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
 
     def get_tracks_from_playlist(self, tracks_href):
-        # print(tracks_href)
-        self.refresh_access_token()
-        _r = requests.get(
-            tracks_href,
-            params={
-                'limit': 100
-            },
-            headers={
-                "Authorization": "Bearer {}".format(self.access_token),
-            })
-        if 'items' in _r.json():
-            return _r.json()['items']
-        return None
+        """The items of a playlist, as an iterator which fetches pages as it goes."""
+        pages = self.get_pages(tracks_href, 100)
+        if pages is None:
+            return None
+        return chain.from_iterable(pages)
 
     def get_playlist(self, playlist_name):
         tracks_href = self.get_tracks_href_from_playlist(playlist_name)
+        if tracks_href is None:
+            return None
         return self.get_tracks_from_playlist(tracks_href)
 
     def get_track(self, song):
-        self.refresh_access_token()
-        try:
-            _r = requests.get(
-                'https://api.spotify.com/v1/search',
-                params={
-                    'q': song,
-                    'type': 'track'
-                },
-                headers={
-                    "Authorization": "Bearer {}".format(self.access_token)
-                }
-            )
-            # return best match
-            return _r.json()['tracks']['items'][0]
-        except Exception:
-            return None
+        return self.favourite('track', song) or self.search(song, 'track')
 
     def get_tracks_from_album(self, album):
-        self.refresh_access_token()
-        try:
-            _r = requests.get(
-                'https://api.spotify.com/v1/search',
-                params={
-                    'q': album,
-                    'type': 'album'
-                },
-                headers={
-                    "Authorization": "Bearer {}".format(self.access_token)
-                }
-            )
-            # return best match
-            album = _r.json()['albums']['items'][0]
-            _r = requests.get(
-                'https://api.spotify.com/v1/albums/{}/tracks'.format(album['id']),
-                params={},
-                headers={
-                    "Authorization": "Bearer {}".format(self.access_token)
-                }
-            )
-            return _r.json()['items']
-        except Exception:
+        album = self.favourite('album', album) or self.search(album, 'album')
+        if album is None:
+            return None
+        pages = self.get_pages(self.session.api('v1/albums/{}/tracks'.format(album['id'])), 50)
+        if pages is None:
             return None
+        return chain.from_iterable(pages)
 
     def add_song(self, artist, song):
         # Pick first artist when more than one artist featured in the song. Format: Artist1;Artist2
         artist = artist.split(';')[0]
-        self.refresh_access_token()
         # First, get the id of the song
         track = self.get_track("track:" + '"' + song + '"' + ' artist:' + '"' + artist + '"')
+        if track is None:
+            print("The track could not be found")
+            return None
         try:
-            requests.put(
-                'https://api.spotify.com/v1/me/tracks',
+            self.session.put(
+                self.session.api('v1/me/tracks'),
                 params={
                     "ids": track['id']
-                },
-                headers={
-                    "Authorization": "Bearer {}".format(self.access_token)
                 }
             )
-        except Exception:
+        except requests.RequestException:
             print("The track could not be added")
             return None
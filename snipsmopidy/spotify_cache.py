@@ -0,0 +1,119 @@
+# -*-: coding utf-8 -*-
+""" Persistent LRU cache of Spotify search results. """
+
+from __future__ import unicode_literals
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+
+MAX_ENTRIES = 2000
+# Entries younger than this are served without revalidation, in seconds.
+FRESH_TTL = 24 * 3600
+# Entries older than this are never served, in seconds.
+MAX_AGE = 30 * 24 * 3600
+
+
+def cache_key(search_type, query):
+    return search_type, ' '.join(query.lower().split())
+
+
+class SearchCache:
+    """LRU cache of search results keyed on search type and normalised query.
+
+    Entries are bounded in number and age. When ``path`` is given they are
+    also kept in a sqlite database, so the cache survives restarts.
+
+    :param path: The sqlite file to persist entries to, or None to keep them in memory only
+    """
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES, fresh_ttl=FRESH_TTL, max_age=MAX_AGE):
+        self.max_entries = max_entries
+        self.fresh_ttl = fresh_ttl
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache ("
+                " type TEXT, query TEXT, stored_at REAL, value TEXT,"
+                " PRIMARY KEY (type, query))")
+            self._load()
+
+    def _load(self):
+        cutoff = time.time() - self.max_age
+        with self._db:
+            self._db.execute("DELETE FROM search_cache WHERE stored_at < ?", (cutoff,))
+        rows = self._db.execute(
+            "SELECT type, query, stored_at, value FROM search_cache ORDER BY stored_at DESC LIMIT ?",
+            (self.max_entries,))
+        for search_type, query, stored_at, value in reversed(rows.fetchall()):
+            self._entries[(search_type, query)] = (stored_at, json.loads(value))
+
+    def get(self, search_type, query):
+        """Look up a cached result.
+
+        :return: A ``(value, fresh)`` tuple, or None if nothing usable is cached
+        """
+        key = cache_key(search_type, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            age = time.time() - entry[0]
+            if age > self.max_age:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], age <= self.fresh_ttl
+
+    def entries(self):
+        """The ``(search_type, query, value)`` of every cached result, oldest first."""
+        with self._lock:
+            return [key + (value,) for key, (stored_at, value) in self._entries.items()]
+
+    def put(self, search_type, query, value):
+        key = cache_key(search_type, query)
+        stored_at = time.time()
+        with self._lock:
+            self._entries[key] = (stored_at, value)
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?)",
+                        key + (stored_at, json.dumps(value)))
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def put_many(self, search_type, items):
+        """Cache several ``(query, value)`` results at once, in one database transaction."""
+        stored_at = time.time()
+        rows = []
+        with self._lock:
+            for query, value in items:
+                key = cache_key(search_type, query)
+                self._entries[key] = (stored_at, value)
+                self._entries.move_to_end(key)
+                rows.append(key + (stored_at, json.dumps(value)))
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                key = next(iter(self._entries))
+                del self._entries[key]
+                evicted.append(key)
+            if self._db is not None:
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?)", rows)
+                    self._db.executemany("DELETE FROM search_cache WHERE type = ? AND query = ?", evicted)
+
+    def _remove(self, key):
+        del self._entries[key]
+        if self._db is not None:
+            with self._db:
+                self._db.execute("DELETE FROM search_cache WHERE type = ? AND query = ?", key)
+
+    def __len__(self):
+        return len(self._entries)
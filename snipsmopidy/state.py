@@ -0,0 +1,198 @@
+# -*-: coding utf-8 -*-
+""" In-memory mirror of each room's player state and queue. """
+
+from __future__ import unicode_literals
+from collections import namedtuple
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+STATE_SUBSYSTEMS = ('player', 'mixer', 'playlist', 'options')
+
+
+class PlayerState(namedtuple('PlayerState', 'state volume song queue_length random repeat elapsed updated_at')):
+    """A snapshot of a room's player: its status and current song.
+
+    ``song`` is the ``currentsong`` dict, or None when there is none.
+    ``elapsed`` is the position in the song when the snapshot was taken, at
+    ``updated_at`` on the ``time.monotonic()`` clock.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_status(cls, status, song):
+        volume = status.get('volume')
+        elapsed = status.get('elapsed')
+        return cls(
+            state=status.get('state'),
+            volume=int(volume) if volume is not None and int(volume) >= 0 else None,
+            song=song or None,
+            queue_length=int(status.get('playlistlength', 0)),
+            random=status.get('random') == '1',
+            repeat=status.get('repeat') == '1',
+            elapsed=float(elapsed) if elapsed is not None else None,
+            updated_at=time.monotonic(),
+        )
+
+    def position(self):
+        """The current position in the song, in seconds, or None if unknown."""
+        if self.elapsed is None:
+            return None
+        if self.state != 'play':
+            return self.elapsed
+        return self.elapsed + time.monotonic() - self.updated_at
+
+
+class RoomState:
+    """The player state of one room, kept up to date from MPD ``idle`` events.
+
+    Each ``player``, ``mixer``, ``playlist`` or ``options`` event refreshes the
+    snapshot with ``status`` and ``currentsong`` in one command list, so
+    readers answer from memory without a round trip. Subscribers are called
+    with every new snapshot, on the room's watcher thread.
+
+    :param connections: The MopidyConnectionManager to take connections from
+    :param room: The room whose player is mirrored
+    """
+
+    def __init__(self, connections, room):
+        self.connections = connections
+        self.room = room
+        self.snapshot = None
+        self.ready = threading.Event()
+        self._subscribers = []
+        self._lock = threading.Lock()
+        connections.subscribe(room, self._on_change, *STATE_SUBSYSTEMS)
+
+    def _on_change(self, subsystem):
+        self.refresh()
+
+    def refresh(self, client=None):
+        """Fetch the player state from MPD now and notify subscribers.
+
+        The state is fetched on ``client``, or else a connection from the
+        pool. If that fails the snapshot is dropped, as it may have missed
+        the change, and the next ``get()`` fetches it again.
+        """
+        try:
+            if client is None:
+                with self.connections.connection(self.room) as client:
+                    status, song = self._fetch(client)
+            else:
+                status, song = self._fetch(client)
+        except Exception:
+            self.snapshot = None
+            raise
+        snapshot = PlayerState.from_status(status, song)
+        with self._lock:
+            self.snapshot = snapshot
+            subscribers = list(self._subscribers)
+        self.ready.set()
+        for callback in subscribers:
+            try:
+                callback(snapshot)
+            except Exception:
+                LOG.exception("Handling the player state of %s failed", self.room)
+        return snapshot
+
+    @staticmethod
+    def _fetch(client):
+        client.command_list_ok_begin()
+        client.status()
+        client.currentsong()
+        return client.command_list_end()
+
+    def get(self, client=None):
+        """The latest snapshot, fetched first, on ``client`` if given, if none has arrived yet."""
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self.refresh(client)
+        return snapshot
+
+    def subscribe(self, callback):
+        """Call ``callback(snapshot)`` with every new snapshot of the room.
+
+        The current snapshot, if there is one, is delivered right away.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+            snapshot = self.snapshot
+        if snapshot is not None:
+            callback(snapshot)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+
+class RoomQueue:
+    """The queue of one room, as ``(id, uri)`` per position, kept up to date from MPD ``playlist`` events.
+
+    The queue is fetched in full once; after that each change only fetches
+    the songs MPD reports changed since the last known queue version, with
+    ``plchanges``, which is nothing when the queue did not change.
+
+    :param connections: The MopidyConnectionManager to take connections from
+    :param room: The room whose queue is mirrored
+    """
+
+    def __init__(self, connections, room):
+        self.connections = connections
+        self.room = room
+        self.version = None
+        self.entries = []
+        self._lock = threading.Lock()
+        connections.subscribe(room, self._on_change, 'playlist')
+
+    def _on_change(self, subsystem):
+        self.refresh()
+
+    def refresh(self, client=None):
+        """Bring the mirror up to date, on ``client`` or else a connection from the pool.
+
+        :return: The ``(id, uri)`` entries of the queue, in order
+        """
+        if client is None:
+            with self.connections.connection(self.room) as client:
+                return self.refresh(client)
+        with self._lock:
+            entries = self._fetch(client, self.version)
+            if entries is None:
+                # The changes did not line up with the mirror, fetch the whole queue again.
+                entries = self._fetch(client, None)
+            return entries
+
+    def _fetch(self, client, version):
+        client.command_list_ok_begin()
+        client.status()
+        if version is None:
+            client.playlistinfo()
+        else:
+            client.plchanges(version)
+        status, songs = client.command_list_end()
+        entries = list(self.entries) if version is not None else []
+        del entries[int(status.get('playlistlength', 0)):]
+        for song in songs:
+            pos = int(song['pos'])
+            entry = (int(song['id']), song['file'])
+            if pos < len(entries):
+                entries[pos] = entry
+            elif pos == len(entries):
+                entries.append(entry)
+            else:
+                return None
+        self.entries = entries
+        self.version = status.get('playlist')
+        return entries
+
+    def get(self, client=None):
+        """The latest entries, fetched first, on ``client`` if given, if the queue was never fetched."""
+        if self.version is None:
+            return self.refresh(client)
+        return self.entries
+
+    def uris(self, client=None):
+        return [uri for _, uri in self.get(client)]
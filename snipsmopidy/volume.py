@@ -0,0 +1,108 @@
+# -*-: coding utf-8 -*-
+""" Per-room volume tracking and coalescing. """
+
+from __future__ import unicode_literals
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+MAX_VOLUME = 100
+# Volume changes requested within this many seconds are sent as one setvol.
+VOLUME_DEBOUNCE = 0.15
+
+
+class RoomVolume:
+    """The volume of one room, as last reported by MPD and as requested.
+
+    The known volume and player state follow the room's RoomState, so no
+    ``status`` round trip is needed per request. Restores and adjustments
+    only move a target, which is sent with a single ``setvol`` once no
+    further change arrives within VOLUME_DEBOUNCE. Ducking is sent right
+    away, so the hotword is not heard over the music.
+
+    :param connections: The MopidyConnectionManager to take connections from
+    :param player: The RoomState of the room whose volume is tracked
+    """
+
+    def __init__(self, connections, player):
+        self.connections = connections
+        self.player = player
+        self.room = player.room
+        self.volume = None
+        self.state = None
+        self.ducked_from = None
+        self.target = None
+        self._lock = threading.Lock()
+        self._timer = None
+        player.subscribe(self._update)
+
+    def _update(self, snapshot):
+        with self._lock:
+            if snapshot.volume is not None:
+                self.volume = snapshot.volume
+            self.state = snapshot.state
+
+    def _ensure_known(self):
+        if self.volume is None:
+            self._update(self.player.get())
+        return self.volume is not None
+
+    def _current(self):
+        return self.target if self.target is not None else self.volume
+
+    def duck(self, low_volume):
+        if not self._ensure_known():
+            return
+        with self._lock:
+            if self.state != 'play' or self.ducked_from is not None:
+                return
+            current = self._current()
+            self.ducked_from = current
+            self.target = min(low_volume, current)
+        self.flush()
+
+    def restore(self):
+        with self._lock:
+            if self.ducked_from is None:
+                return
+            self.target, self.ducked_from = self.ducked_from, None
+        self._schedule()
+
+    def adjust(self, delta):
+        if not self._ensure_known():
+            return
+        with self._lock:
+            base = self.ducked_from if self.ducked_from is not None else self._current()
+            self.ducked_from = None
+            self.target = max(0, min(base + delta, MAX_VOLUME))
+        self._schedule()
+
+    def set(self, volume):
+        with self._lock:
+            self.ducked_from = None
+            self.target = max(0, min(int(volume), MAX_VOLUME))
+        self._schedule()
+
+    def _schedule(self):
+        with self._lock:
+            if self._timer is None:
+                self._timer = threading.Timer(VOLUME_DEBOUNCE, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Send the pending target volume now, if it differs from MPD's."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            target, self.target = self.target, None
+            if target is None or target == self.volume:
+                return
+            self.volume = target
+        try:
+            with self.connections.connection(self.room) as client:
+                client.setvol(target)
+        except Exception:
+            LOG.exception("Setting the volume of %s failed", self.room)
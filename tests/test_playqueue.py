@@ -0,0 +1,165 @@
+# -*-: coding utf-8 -*-
+""" Tests of the queue helpers and of syncing a room's queue. """
+
+from __future__ import unicode_literals
+import random
+import unittest
+
+from mpd import CommandError
+
+from benchmarks.fake_mopidy import FakeLibrary, FakeMopidyServer
+from snipsmopidy.playqueue import in_queue_order, queue_diff, run_command_list
+from snipsmopidy.snipsmopidy import SnipsMopidy
+
+
+def apply_commands(entries, commands):
+    """The URIs of a queue of ``(id, uri)`` entries after the commands of queue_diff."""
+    queue = list(entries)
+    next_id = max([song_id for song_id, _ in entries] + [0]) + 1
+    for command in commands:
+        if command[0] == 'deleteid':
+            queue = [entry for entry in queue if entry[0] != command[1]]
+        elif command[0] == 'moveid':
+            pos = next(pos for pos, entry in enumerate(queue) if entry[0] == command[1])
+            queue.insert(command[2], queue.pop(pos))
+        elif command[0] == 'addid':
+            if len(command) > 2:
+                assert command[2] <= len(queue)
+                queue.insert(command[2], (next_id, command[1]))
+            else:
+                queue.append((next_id, command[1]))
+            next_id += 1
+    return [uri for _, uri in queue]
+
+
+class QueueDiffTest(unittest.TestCase):
+
+    def test_same_queue(self):
+        entries = list(enumerate(['a', 'b', 'c'], 1))
+        self.assertEqual(queue_diff(entries, ['a', 'b', 'c']), [])
+
+    def test_empty_queue(self):
+        self.assertEqual(queue_diff([], ['a', 'b']), [('addid', 'a'), ('addid', 'b')])
+
+    def test_moves_only_songs_out_of_order(self):
+        entries = list(enumerate(['a', 'b', 'c', 'd'], 1))
+        self.assertEqual(queue_diff(entries, ['b', 'c', 'd', 'a']), [('moveid', 1, 3)])
+
+    def test_deletes_and_adds(self):
+        entries = list(enumerate(['a', 'b', 'c'], 1))
+        commands = queue_diff(entries, ['a', 'x', 'c'])
+        self.assertEqual(commands, [('deleteid', 2), ('addid', 'x', 1)])
+
+    def test_gives_wanted_queue(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            uris = ['u{}'.format(i) for i in range(rng.randint(1, 10))]
+            current = [rng.choice(uris) for _ in range(rng.randint(0, 10))]
+            wanted = [rng.choice(uris) for _ in range(rng.randint(0, 10))]
+            entries = list(enumerate(current, 1))
+            self.assertEqual(apply_commands(entries, queue_diff(entries, wanted)), wanted)
+
+    def test_long_queue(self):
+        rng = random.Random(1)
+        uris = ['u{}'.format(i) for i in range(2000)]
+        entries = list(enumerate(uris, 1))
+        wanted = rng.sample(uris, 1500) + ['x{}'.format(i) for i in range(100)]
+        rng.shuffle(wanted)
+        self.assertEqual(apply_commands(entries, queue_diff(entries, wanted)), wanted)
+
+    def test_limit(self):
+        entries = list(enumerate(['a', 'b', 'c'], 1))
+        self.assertIsNone(queue_diff(entries, ['x', 'y', 'z'], limit=4))
+        self.assertIsNone(queue_diff(entries, ['b', 'c', 'a'], limit=0))
+        self.assertEqual(queue_diff(entries, ['b', 'c', 'a'], limit=1), [('moveid', 1, 2)])
+        self.assertEqual(queue_diff(entries, ['a', 'b', 'c'], limit=0), [])
+
+
+class InQueueOrderTest(unittest.TestCase):
+
+    def test_queued_first_in_queue_order(self):
+        entries = list(enumerate(['c', 'x', 'a'], 1))
+        self.assertEqual(in_queue_order(entries, ['a', 'b', 'c']), ['c', 'a', 'b'])
+
+    def test_duplicates(self):
+        entries = list(enumerate(['a', 'b', 'a'], 1))
+        self.assertEqual(in_queue_order(entries, ['b', 'a', 'b']), ['a', 'b', 'b'])
+
+
+class FakeClient:
+    """Command lists of a client whose queue rejects some URIs."""
+
+    def __init__(self, unavailable):
+        self.unavailable = unavailable
+        self.sent = []
+        self._list = None
+
+    def command_list_ok_begin(self):
+        self._list = []
+
+    def command_list_end(self):
+        commands, self._list = self._list, None
+        for offset, command in enumerate(commands):
+            if command[0] in ('add', 'addid') and command[1] in self.unavailable:
+                error = CommandError("No such song")
+                error.offset = offset
+                raise error
+            self.sent.append(command)
+
+    def __getattr__(self, name):
+        return lambda *args: self._list.append((name,) + args)
+
+
+class RunCommandListTest(unittest.TestCase):
+
+    def test_skips_failing_add(self):
+        client = FakeClient({'b'})
+        failed = run_command_list(client, [('add', 'a'), ('add', 'b'), ('add', 'c'), ('play',)])
+        self.assertEqual(failed, ['b'])
+        self.assertEqual(client.sent, [('add', 'a'), ('add', 'c'), ('play',)])
+
+    def test_failing_addid_aborts(self):
+        client = FakeClient({'b'})
+        with self.assertRaises(CommandError):
+            run_command_list(client, [('addid', 'a'), ('addid', 'b', 0), ('play', 0)])
+        self.assertEqual(client.sent, [('addid', 'a')])
+
+
+class SyncQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = FakeLibrary(size=50, n_playlists=1, playlist_size=10)
+        self.server = FakeMopidyServer(self.library).start()
+        self.skill = SnipsMopidy({'default': {'host': '127.0.0.1', 'port': self.server.port}}, autoplay=False)
+
+    def tearDown(self):
+        self.skill.connections.close()
+        self.server.stop()
+
+    def sync(self, uris):
+        with self.skill.connections.connection('default') as client:
+            return self.skill.sync_queue('default', client, uris)
+
+    def queue(self):
+        return [entry['file'] for entry in self.server.queue]
+
+    def test_keeps_queued_songs(self):
+        uris = [song['file'] for song in self.library.songs[:10]]
+        self.sync(uris)
+        ids = [entry['id'] for entry in self.server.queue]
+        self.sync(uris[1:] + uris[:1])
+        self.assertEqual(self.queue(), uris[1:] + uris[:1])
+        self.assertEqual(sorted(entry['id'] for entry in self.server.queue), sorted(ids))
+
+    def test_unavailable_song_keeps_order(self):
+        uris = [song['file'] for song in self.library.songs[:10]]
+        self.sync(uris)
+        wanted = uris[:3] + [self.library.songs[20]['file'], self.library.songs[21]['file']] + uris[3:]
+        self.server.unavailable.add(self.library.songs[20]['file'])
+        failed = self.sync(wanted)
+        self.assertEqual(failed, [self.library.songs[20]['file']])
+        self.assertEqual(self.queue(), [uri for uri in wanted if uri != self.library.songs[20]['file']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*-: coding utf-8 -*-
+""" Tests of the spoken name normalisation and of the entity resolver. """
+
+from __future__ import unicode_literals
+import unittest
+
+from snipsmopidy.index import words
+from snipsmopidy.resolver import FUZZ_RATIO, EntityResolver
+
+
+class WordsTest(unittest.TestCase):
+
+    def test_plain_words(self):
+        self.assertEqual(words("Guns N' Roses"), ['guns', 'n', 'roses'])
+        self.assertEqual(words('Beyoncé'), ['beyonce'])
+
+    def test_spoken_numbers(self):
+        self.assertEqual(words('maroon five'), ['maroon', '5'])
+        self.assertEqual(words('volume one'), ['volume', '1'])
+        self.assertEqual(words('thirteen'), ['13'])
+        self.assertEqual(words('forty two'), ['42'])
+
+    def test_numbers_said_in_parts(self):
+        self.assertEqual(words('blink one eighty two'), ['blink', '182'])
+        self.assertEqual(words('one hundred eighty two'), ['182'])
+        self.assertEqual(words('nineteen eighty four'), ['1984'])
+        self.assertEqual(words('twenty twenty'), ['2020'])
+        self.assertEqual(words('two thousand one hundred'), ['2100'])
+
+    def test_separate_numbers(self):
+        self.assertEqual(words('one two three'), ['1', '2', '3'])
+        self.assertEqual(words('one direction'), ['1', 'direction'])
+
+    def test_scale_without_number(self):
+        self.assertEqual(words('hundred'), ['hundred'])
+        self.assertEqual(words('thousand foot krutch'), ['thousand', 'foot', 'krutch'])
+
+
+ARTISTS = [
+    'Maroon 5', 'Blink-182', 'The Beatles', 'Ed Sheeran', 'Linkin Park', 'Nirvana', "Guns N' Roses",
+    'The Cars', 'Prince', 'Beck', 'Sting', 'Metallica', 'Mase',
+]
+
+
+class ResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = EntityResolver()
+        self.resolver.update('library', 'artist', ARTISTS)
+        self.resolver.update('library', 'album', ['Volume 1', 'Volume 2', 'Volume 3'])
+
+    def best(self, query, kind='artist'):
+        match = self.resolver.best(query, kind, min_score=FUZZ_RATIO)
+        return match.name if match is not None else None
+
+    def test_exact(self):
+        match = self.resolver.best('the beatles', 'artist')
+        self.assertEqual((match.name, match.score), ('The Beatles', 100))
+
+    def test_spelled_out_numbers(self):
+        self.assertEqual(self.best('maroon five'), 'Maroon 5')
+        self.assertEqual(self.best('blink one eighty two'), 'Blink-182')
+        self.assertEqual(self.best('volume two', 'album'), 'Volume 2')
+
+    def test_misspelled(self):
+        self.assertEqual(self.best('the beetles'), 'The Beatles')
+        self.assertEqual(self.best('nirvanna'), 'Nirvana')
+        self.assertEqual(self.best('guns and roses'), "Guns N' Roses")
+
+    def test_sounds_alike(self):
+        self.assertEqual(self.best('ed sharon'), 'Ed Sheeran')
+        self.assertEqual(self.best('lincoln park'), 'Linkin Park')
+
+    def test_other_names_alike(self):
+        for query in ('the cure', 'princess', 'back', 'stink', 'metal', 'muse'):
+            self.assertIsNone(self.best(query), query)
+
+    def test_other_number(self):
+        self.assertIsNone(self.best('volume four', 'album'))
+        self.assertIsNone(self.best('maroon six'))
+
+    def test_ranking(self):
+        matches = self.resolver.resolve('volume', ('album',), limit=3)
+        self.assertEqual(matches, [])
+        matches = self.resolver.resolve('the beetles', ('artist',), limit=3)
+        self.assertEqual(matches[0].name, 'The Beatles')
+        self.assertEqual([match.score for match in matches], sorted((match.score for match in matches), reverse=True))
+
+    def test_exact_lookup(self):
+        self.assertEqual(self.resolver.exact('Cars, the', 'artist').name, 'The Cars')
+        self.assertIsNone(self.resolver.exact('the cure', 'artist'))
+        self.assertIsNone(self.resolver.exact('the cars', 'album'))
+
+    def test_sources(self):
+        self.resolver.add('spotify', 'artist', 'The Cure')
+        self.assertEqual(self.resolver.best('the cure', 'artist', sources=('spotify',)).source, 'spotify')
+        self.assertIsNone(self.resolver.best('the cure', 'artist', sources=('library',), min_score=FUZZ_RATIO))
+
+
+if __name__ == '__main__':
+    unittest.main()
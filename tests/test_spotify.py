@@ -0,0 +1,41 @@
+# -*-: coding utf-8 -*-
+""" Tests of the Spotify client against the fake Spotify server. """
+
+from __future__ import unicode_literals
+import unittest
+
+from benchmarks.fake_spotify import FakeSpotifyServer
+from snipsmopidy.spotify import SpotifyClient
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSpotifyServer().start()
+        self.client = SpotifyClient(
+            'refresh', 'id', 'secret', api_url=self.server.api_url, token_url=self.server.token_url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def searches(self):
+        return self.server.requests.get('search', 0)
+
+    def test_cached(self):
+        item = self.client.search('The Cars', 'artist')
+        self.assertEqual(self.client.search('the  cars', 'artist'), item)
+        self.assertEqual(self.searches(), 1)
+
+    def test_cached_under_other_spelling(self):
+        item = self.client.search('The Cars', 'artist')
+        self.assertEqual(self.client.search('Cars, The', 'artist'), item)
+        self.assertEqual(self.searches(), 1)
+
+    def test_name_alike_is_searched(self):
+        self.client.search('The Cars', 'artist')
+        self.assertEqual(self.client.search('the cure', 'artist')['name'], 'the cure')
+        self.assertEqual(self.searches(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()